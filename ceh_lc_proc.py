@@ -1,17 +1,18 @@
-import os
-import glob
 import tomli
+import rasterio
 import numpy as np
-import xarray as xr
 import pandas as pd
 import geopandas as gpd
 import spatial as sp
 from pathlib import Path
-from osgeo import gdal
-from scipy.ndimage import binary_erosion
+from functools import partial
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from scipy.ndimage import distance_transform_cdt, maximum_filter, minimum_filter
 
-# from rasterstats import zonal_stats
 from configuration import config
+from executor import iter_cells, map_cells
+from raster_processing import raster_windows, read_window
 
 
 def file_name_without_extension(file_name):
@@ -48,105 +49,517 @@ def sample_lc_regions(dfr, sample_size):
     return sampled.reset_index(drop=True)
 
 
-def split_to_tiles(file_name):
-    file_name_wt_ext = file_name_without_extension(file_name)
-    ds = gdal.Open(file_name, gdal.GA_ReadOnly)
-    width = ds.RasterXSize
-    height = ds.RasterYSize
-    print(width, "x", height)
-    tilesize = 11000
-    for i in range(0, width, tilesize):
-        for j in range(0, height, tilesize):
-            w = min(i + tilesize, width) - i
-            h = min(j + tilesize, height) - j
-            gdaltranString = (
-                "gdal_translate -of GTIFF -srcwin "
-                + str(i)
-                + ", "
-                + str(j)
-                + ", "
-                + str(w)
-                + ", "
-                + str(h)
-                + " "
-                + file_name
-                + " "
-                + file_name_wt_ext
-                + "_"
-                + str(i)
-                + "_"
-                + str(j)
-                + ".tif"
-            )
-            os.system(gdaltranString)
-
-
-def ceh_tiles_region_value_counts(
-    data_dir: str, land_cover_file_name: str
+def region_raster_file_path(data_dir: str, land_cover_file_name: str):
+    """Return path of HadUKP region codes rasterized on the land cover grid"""
+    file_base_str = file_name_without_extension(land_cover_file_name)
+    file_path = Path(data_dir, file_base_str + "_regions.tif")
+    return file_path
+
+
+def rasterize_regions(
+    data_dir: str, land_cover_file_name: str, block_size: int = 11000
+):
+    """
+    Rasterize HadUKP regions onto the CEH land cover grid block by block
+    and save as uint8 raster of region codes (row number in the regions
+    file + 1, 0 outside regions). Done once, the raster is reused if it
+    exists.
+    """
+    out_path = region_raster_file_path(data_dir, land_cover_file_name)
+    if out_path.is_file():
+        return out_path
+    regions = gpd.read_file(config["regions_file"])
+    regions = regions.set_crs("EPSG:27700")
+    shapes = [(geom, nr + 1) for nr, geom in enumerate(regions.geometry.values)]
+    file_name = Path(data_dir, land_cover_file_name)
+    with rasterio.open(file_name) as src:
+        profile = src.profile
+        profile.update(dtype="uint8", count=1, nodata=0, compress="deflate")
+        with rasterio.open(out_path, "w", **profile) as dst:
+            for window in raster_windows(file_name, block_size):
+                codes = rasterize(
+                    shapes,
+                    out_shape=(window.height, window.width),
+                    transform=src.window_transform(window),
+                    fill=0,
+                    dtype="uint8",
+                )
+                dst.write(codes, 1, window=window)
+    return out_path
+
+
+def assign_region_codes(dfr: pd.DataFrame) -> pd.DataFrame:
+    """Replace region_code column of dfr (as in rasterize_regions) with the
+    attribute columns of the regions, without a second spatial join"""
+    regions = gpd.read_file(config["regions_file"]).drop(columns="geometry")
+    attributes = regions.iloc[dfr["region_code"].to_numpy().astype(np.int64) - 1]
+    dfr = dfr.drop("region_code", axis=1)
+    for column in attributes.columns:
+        dfr[column] = attributes[column].to_numpy()
+    return dfr
+
+
+def window_region_lc_counts(
+    window: Window, lc_file_name: str, region_file_name: str, n_regions: int
+) -> np.ndarray:
+    """Count land cover codes per region code in a raster window with a
+    single np.bincount over region_code * 22 + lc_code"""
+    with rasterio.open(lc_file_name) as src:
+        lc_codes = src.read(1, window=window)
+    with rasterio.open(region_file_name) as src:
+        region_codes = src.read(1, window=window)
+    # codes above 21 (e.g. nodata 255) would spill into other regions
+    valid = lc_codes <= 21
+    counts = np.bincount(
+        region_codes[valid].astype(np.int64) * 22 + lc_codes[valid],
+        minlength=(n_regions + 1) * 22,
+    )
+    return counts
+
+
+def ceh_region_value_counts(
+    data_dir: str,
+    land_cover_file_name: str,
+    block_size: int = 11000,
+    backend: str = None,
 ) -> pd.DataFrame:
     """
-    Iteratively reads CEH land cover raster tiles found in data_dir that match
-    file_base_* and compiles land cover value counts into a single results
-    """
-    file_base = file_name_without_extension(land_cover_file_name)
-    tiles = glob.glob(str(Path(data_dir, file_base + "_*.tif")))
-    regions_file = config["regions_file"]
-    regions_dfr = gpd.read_file(regions_file)
-    regions = regions_dfr.Region.values
-    data = {}
-    for region in regions:
-        data[region] = np.zeros(21)
-    dfr = pd.DataFrame(data, index=range(1, 22, 1))
-    for tile in tiles:
-        print(tile)
-        stats = zonal_stats(regions_file, tile, categorical=True)
-        for nr, region in enumerate(regions):
-            for lc in range(1, 22, 1):
-                try:
-                    dfr.loc[lc, region] += stats[nr][lc]
-                except KeyError:
-                    pass
-        print(dfr.max())
+    Compile CEH land cover (index) value counts per HadUKP region
+    (columns). Counts of block_size raster windows, optionally processed
+    in parallel, are accumulated into a single result.
+    """
+    regions = gpd.read_file(config["regions_file"]).Region.values
+    file_name = str(Path(data_dir, land_cover_file_name))
+    region_file_name = str(
+        rasterize_regions(data_dir, land_cover_file_name, block_size)
+    )
+    count = partial(
+        window_region_lc_counts,
+        lc_file_name=file_name,
+        region_file_name=region_file_name,
+        n_regions=len(regions),
+    )
+    windows = raster_windows(file_name, block_size)
+    counts = sum(map_cells(count, [(window,) for window in windows], backend))
+    counts = counts.reshape(len(regions) + 1, 22)
+    dfr = pd.DataFrame(counts[1:, 1:].T, index=range(1, 22, 1), columns=regions)
     return dfr
 
 
-def ceh_tiles_binary_erosion(
-    lc: int, window_size: int, data_dir: str, land_cover_file_name: str
+def erode_classes(values: np.ndarray, lcs: list, window_size: int) -> np.ndarray:
+    """
+    Binary erosion of all land cover classes in lcs in one pass. A pixel
+    is kept if every pixel in the window_size x window_size window around
+    it has the same class, which equals binary_erosion of values == lc
+    with a square window for each lc. Returns class array with 0 for
+    eroded pixels.
+    """
+    low = minimum_filter(values, size=window_size, mode="constant", cval=0)
+    high = maximum_filter(values, size=window_size, mode="constant", cval=0)
+    keep = (low == high) & np.isin(values, lcs)
+    return np.where(keep, values, 0).astype(values.dtype)
+
+
+def window_binary_erosion(
+    window: Window, file_name: str, lcs: list, window_size: int
+) -> dict:
+    """
+    Erode all lcs classes of a raster window read with a window_size // 2
+    overlap from the neighbouring blocks, so results match the unblocked
+    raster. Returns dict of dataframes of remaining pixel centre (y, x)
+    per lc.
+    """
+    halo = window_size // 2
+    with rasterio.open(file_name) as src:
+        values = read_window(src, window, halo)
+        transform = src.window_transform(window)
+    eroded = erode_classes(values, lcs, window_size)
+    return eroded_pixels(eroded, transform, lcs, halo)
+
+
+def pixel_centres(rows: np.ndarray, cols: np.ndarray, transform) -> tuple:
+    """Return int32 OSGB (y, x) of pixel centres at window rows and cols"""
+    y = np.rint(transform.f + (rows + 0.5) * transform.e).astype("int32")
+    x = np.rint(transform.c + (cols + 0.5) * transform.a).astype("int32")
+    return y, x
+
+
+def eroded_pixels(eroded: np.ndarray, transform, lcs: list, halo: int = 0) -> dict:
+    """
+    Return dict of dataframes of the non zero pixels of eroded class array
+    (excluding halo pixels on every side) per lc, with OSGB pixel centre
+    (y, x) as int32 index and uint8 lc column. Only the kept pixels are
+    materialised.
+    """
+    flat = np.flatnonzero(eroded)
+    lc_values = eroded.ravel()[flat].astype("uint8")
+    rows, cols = np.divmod(flat, eroded.shape[1])
+    rows -= halo
+    cols -= halo
+    inside = (rows >= 0) & (rows < eroded.shape[0] - 2 * halo)
+    inside &= (cols >= 0) & (cols < eroded.shape[1] - 2 * halo)
+    rows, cols, lc_values = rows[inside], cols[inside], lc_values[inside]
+    y, x = pixel_centres(rows, cols, transform)
+    dfr = pd.DataFrame({"y": y, "x": x, "lc": lc_values})
+    dfr = dfr.set_index(["y", "x"])
+    return {lc: dfr[dfr.lc == lc] for lc in lcs}
+
+
+def ceh_binary_erosion(
+    lcs: list,
+    window_size: int,
+    data_dir: str,
+    land_cover_file_name: str,
+    backend: str = "process",
+    block_size: int = 11000,
 ):
     """
-    Reads CEH land cover raster tiles found in data_dir that match
-    file_base_*, selects pixels that equal the lc argument, performs
-    binary errosion using window_size and saves the remaining
-    data to dataframe.
-    """
-    dfrs = []
-    file_base = file_name_without_extension(land_cover_file_name)
-    tiles = glob.glob(str(Path(data_dir, file_base + "_*.tif")))
-    print(lc)
-    for tile in tiles:
-        print(tile)
-        lc_prod = xr.open_rasterio(tile)
-        lc_prod = lc_prod.squeeze("band")
-        lc_prod = lc_prod.drop("band")
-        values = lc_prod.where(lc_prod == lc, other=0).values
-        print(values.max())
-        eroding_block = np.ones((window_size, window_size))
-        values_eroded = binary_erosion(
-            values.squeeze(), structure=eroding_block
-        ).astype(int)
-        print(values_eroded.max())
-        lc_prod.values = values_eroded
-        dfr = lc_prod.to_dataframe(name="lc")
-        dfr = dfr[dfr.lc > 0]
-        dfr["lc"] = lc
-        print(dfr.shape)
-        if dfr.shape[0] == 0:
-            continue
-        dfrs.append(dfr)
-    done = pd.concat(dfrs)
-    done.to_parquet(
-        eroded_lc_file_path(lc, window_size, data_dir, land_cover_file_name)
+    Reads CEH land cover raster in data_dir in block_size windows once,
+    performs binary errosion of every land cover in lcs using window_size
+    and saves the remaining pixels of each land cover to dataframe.
+    Windows are processed in parallel workers.
+    """
+    file_name = str(Path(data_dir, land_cover_file_name))
+    erode = partial(
+        window_binary_erosion, file_name=file_name, lcs=lcs, window_size=window_size
     )
+    windows = raster_windows(file_name, block_size)
+    results = map_cells(erode, [(window,) for window in windows], backend)
+    for lc in lcs:
+        dfrs = [res[lc] for res in results if res[lc].shape[0] > 0]
+        print(lc, sum(dfr.shape[0] for dfr in dfrs))
+        done = pd.concat(dfrs)
+        done.to_parquet(
+            eroded_lc_file_path(lc, window_size, data_dir, land_cover_file_name)
+        )
+
+
+def edge_distance_file_path(data_dir: str, land_cover_file_name: str):
+    """Return path of the distance to class edge raster"""
+    file_base_str = file_name_without_extension(land_cover_file_name)
+    file_path = Path(data_dir, file_base_str + "_edge_distance.tif")
+    return file_path
+
+
+def class_edge_distance(
+    values: np.ndarray, lcs: list, max_distance: int = 50
+) -> np.ndarray:
+    """
+    Chessboard distance of every pixel to the nearest pixel of a different
+    class (pixels beyond values count as class 0), capped at max_distance
+    and 0 for classes not in lcs. The nearest different class pixel is
+    always one step beyond the nearest class edge pixel, so all classes
+    are done with a single distance transform. A pixel survives binary
+    erosion with an odd window_size square window if its distance is
+    larger than window_size // 2.
+    """
+    low = minimum_filter(values, size=3, mode="constant", cval=0)
+    high = maximum_filter(values, size=3, mode="constant", cval=0)
+    distance = distance_transform_cdt(low == high, metric="chessboard")
+    # -1 is returned if there are no edge pixels at all
+    distance = np.where(
+        distance < 0, max_distance, np.minimum(distance + 1, max_distance)
+    )
+    distance[~np.isin(values, lcs)] = 0
+    return distance.astype("uint8")
+
+
+def window_edge_distance(
+    window: Window, file_name: str, lcs: list, max_distance: int = 50
+) -> np.ndarray:
+    """Distance to class edge of a raster window read with max_distance
+    overlap, hence capped distances match the unblocked raster"""
+    with rasterio.open(file_name) as src:
+        values = read_window(src, window, max_distance)
+    distance = class_edge_distance(values, lcs, max_distance)
+    return distance[max_distance:-max_distance, max_distance:-max_distance]
+
+
+def ceh_edge_distance(
+    lcs: list,
+    data_dir: str,
+    land_cover_file_name: str,
+    max_distance: int = 50,
+    backend: str = "process",
+    block_size: int = 11000,
+    max_workers: int = None,
+):
+    """
+    Compute distance to class edge of land covers in lcs over the CEH land
+    cover raster and save it as uint8 raster on the same grid. Computed
+    once, eroded pixels for any odd window size up to 2 * max_distance - 1
+    are then a threshold (see ceh_distance_erosion). Windows are processed
+    in parallel with at most max_workers (cpu count by default) in flight
+    and each is written as its result arrives.
+    """
+    out_path = edge_distance_file_path(data_dir, land_cover_file_name)
+    file_name = str(Path(data_dir, land_cover_file_name))
+    distance = partial(
+        window_edge_distance, file_name=file_name, lcs=lcs, max_distance=max_distance
+    )
+    windows = raster_windows(file_name, block_size)
+    with rasterio.open(file_name) as src:
+        profile = src.profile
+    profile.update(dtype="uint8", count=1, nodata=None, compress="deflate")
+    with rasterio.open(out_path, "w", **profile) as dst:
+        cells = [(window,) for window in windows]
+        results = iter_cells(distance, cells, backend, max_workers)
+        for (window,), result in zip(cells, results):
+            dst.write(result, 1, window=window)
+    return out_path
+
+
+def check_odd_window_size(window_size: int):
+    """Raise ValueError for even window_size, thresholding the distance to
+    class edge equals square window binary erosion for odd sizes only"""
+    if window_size % 2 == 0:
+        raise ValueError(
+            f"window_size must be odd for distance erosion, not {window_size}"
+        )
+
+
+def window_distance_erosion(
+    window: Window,
+    file_name: str,
+    distance_file_name: str,
+    lcs: list,
+    window_size: int,
+) -> dict:
+    """Eroded pixels of a raster window by thresholding distance to class
+    edge. Returns dict of dataframes of remaining pixels per lc"""
+    with rasterio.open(file_name) as src:
+        values = src.read(1, window=window)
+        transform = src.window_transform(window)
+    with rasterio.open(distance_file_name) as src:
+        distance = src.read(1, window=window)
+    eroded = np.where(distance > window_size // 2, values, 0).astype("uint8")
+    return eroded_pixels(eroded, transform, lcs)
+
+
+def ceh_distance_erosion(
+    lcs: list,
+    window_size: int,
+    data_dir: str,
+    land_cover_file_name: str,
+    backend: str = "process",
+    block_size: int = 11000,
+):
+    """
+    Same output as ceh_binary_erosion for odd window_size (up to
+    2 * max_distance - 1 of the distance raster), thresholding the distance
+    to class edge raster computed by ceh_edge_distance instead of eroding
+    the land cover raster.
+    """
+    check_odd_window_size(window_size)
+    distance_file_name = str(edge_distance_file_path(data_dir, land_cover_file_name))
+    file_name = str(Path(data_dir, land_cover_file_name))
+    erode = partial(
+        window_distance_erosion,
+        file_name=file_name,
+        distance_file_name=distance_file_name,
+        lcs=lcs,
+        window_size=window_size,
+    )
+    windows = raster_windows(file_name, block_size)
+    results = map_cells(erode, [(window,) for window in windows], backend)
+    for lc in lcs:
+        dfrs = [res[lc] for res in results if res[lc].shape[0] > 0]
+        print(lc, sum(dfr.shape[0] for dfr in dfrs))
+        done = pd.concat(dfrs)
+        done.to_parquet(
+            eroded_lc_file_path(lc, window_size, data_dir, land_cover_file_name)
+        )
+
+
+def group_parts(groups: np.ndarray) -> list:
+    """Return index arrays of the rows of every group code in groups. The
+    stable sort of small integer codes is a radix sort, linear in rows"""
+    order = np.argsort(groups, kind="stable")
+    return np.split(order, np.flatnonzero(np.diff(groups[order])) + 1)
+
+
+def bottom_k_indices(groups: np.ndarray, keys: np.ndarray, k: int) -> np.ndarray:
+    """Return sorted indices of the k smallest keys per group code, picked
+    with np.argpartition within each group without sorting the keys"""
+    selected = [np.array([], dtype=np.int64)]
+    for part in group_parts(groups):
+        if len(part) > k:
+            part = part[np.argpartition(keys[part], k - 1)[:k]]
+        selected.append(part)
+    return np.sort(np.concatenate(selected))
+
+
+def bottom_k_sample(dfr: pd.DataFrame, by: list, sample_size: int) -> pd.DataFrame:
+    """
+    Keep sample_size rows with the smallest random key column per by group.
+    This is a uniform sample without replacement (reservoir sample), and
+    bottom-k samples of disjoint parts merge exactly into the bottom-k
+    sample of the whole.
+    """
+    groups = dfr.groupby(by, sort=False).ngroup().to_numpy()
+    return dfr.iloc[bottom_k_indices(groups, dfr["key"].to_numpy(), sample_size)]
+
+
+def first_k_cells(
+    groups: np.ndarray, keys: np.ndarray, y: np.ndarray, x: np.ndarray, k: int
+) -> tuple:
+    """
+    Return indices and VNP13A1 cells of the pixels of the first k distinct
+    cells per group code in increasing key order. Only the pixels with
+    the smallest keys are reprojected, twice as many each round until k
+    cells are found or the group is exhausted.
+    """
+    selected = [np.array([], dtype=np.int64)]
+    cells = [np.array([], dtype=np.int64)]
+    for part in group_parts(groups):
+        n_pixels = k
+        while True:
+            n_pixels = min(n_pixels, len(part))
+            head = part
+            if n_pixels < len(part):
+                head = part[np.argpartition(keys[part], n_pixels - 1)[:n_pixels]]
+            head = head[np.argsort(keys[head])]
+            head_cells = sp.osgb_to_vnp13a1_cell(x[head], y[head])
+            # first occurrence is the smallest key pixel of each cell
+            first = np.sort(np.unique(head_cells, return_index=True)[1])[:k]
+            if len(first) == k or n_pixels == len(part):
+                break
+            n_pixels *= 2
+        selected.append(head[first])
+        cells.append(head_cells[first])
+    return np.concatenate(selected), np.concatenate(cells)
+
+
+def cell_representatives(dfr: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keep the row with the smallest random key per VNP13A1 cell and lc, so
+    a cell crossing a region boundary is sampled once, for the region of
+    that pixel. Representatives of disjoint parts merge exactly by
+    applying this again.
+    """
+    dfr = dfr.sort_values("key", kind="stable")
+    return dfr.drop_duplicates(["cell", "lc"])
+
+
+def window_eroded_sample(
+    window: Window,
+    file_name: str,
+    distance_file_name: str,
+    region_file_name: str,
+    window_size: int,
+    sample_size: int,
+    seed: int = 0,
+    unique_cells: bool = False,
+) -> pd.DataFrame:
+    """
+    Sample up to sample_size eroded pixels per region and lc of a raster
+    window. Random keys are seeded by seed and the window offsets, so
+    samples do not depend on the order windows are processed in. With
+    unique_cells the representatives of the first VNP13A1 cells in key
+    order are returned per region and lc, sample_size and a margin of a
+    tenth for boundary cells the neighbouring region keeps (see
+    cell_representatives).
+    """
+    with rasterio.open(file_name) as src:
+        values = src.read(1, window=window)
+        transform = src.window_transform(window)
+    with rasterio.open(distance_file_name) as src:
+        distance = src.read(1, window=window)
+    with rasterio.open(region_file_name) as src:
+        region_codes = src.read(1, window=window)
+    # distance is 0 for land covers not eroded
+    flat = np.flatnonzero((distance > window_size // 2) & (region_codes > 0))
+    lc_values = values.ravel()[flat]
+    region_values = region_codes.ravel()[flat]
+    rng = np.random.default_rng([seed, window.col_off, window.row_off])
+    keys = rng.random(len(flat))
+    groups = region_values.astype(np.uint16) * 22 + lc_values
+    if unique_cells:
+        rows, cols = np.divmod(flat, values.shape[1])
+        y, x = pixel_centres(rows, cols, transform)
+        selected, cells = first_k_cells(
+            groups, keys, y, x, sample_size + sample_size // 10
+        )
+        dfr = pd.DataFrame(
+            {
+                "y": y[selected],
+                "x": x[selected],
+                "lc": lc_values[selected],
+                "region_code": region_values[selected],
+                "key": keys[selected],
+                "cell": cells,
+            }
+        )
+        return dfr
+    # k smallest keys per region and lc before any frame is built
+    selected = bottom_k_indices(groups, keys, sample_size)
+    rows, cols = np.divmod(flat[selected], values.shape[1])
+    y, x = pixel_centres(rows, cols, transform)
+    return pd.DataFrame(
+        {
+            "y": y,
+            "x": x,
+            "lc": lc_values[selected],
+            "region_code": region_values[selected],
+            "key": keys[selected],
+        }
+    )
+
+
+def ceh_sample_eroded(
+    lcs: list,
+    window_size: int,
+    sample_size: int,
+    data_dir: str,
+    land_cover_file_name: str,
+    seed: int = 0,
+    backend: str = "process",
+    block_size: int = 11000,
+    unique_cells: bool = False,
+):
+    """
+    Sample sample_size eroded pixels per region for every land cover in
+    lcs while streaming over the land cover raster windows, using the
+    distance to class edge (ceh_edge_distance) and region code rasters.
+    Only the sampled pixels are reprojected, regions are taken from the
+    region code raster so the counts per region and lc are kept.
+    With unique_cells pixels are snapped to the VNP13A1 500 m sinusoidal
+    grid and at most one pixel per cell and lc is sampled, so GEE
+    time series of a cell are extracted once, and the cell id is
+    recorded. Cells are taken in order of their smallest pixel key, hence
+    drawn with probability growing with their number of eroded pixels
+    (as sampling pixels and dropping repeated cells), not uniformly.
+    """
+    check_odd_window_size(window_size)
+    file_name = str(Path(data_dir, land_cover_file_name))
+    distance_file_name = str(edge_distance_file_path(data_dir, land_cover_file_name))
+    region_file_name = str(
+        rasterize_regions(data_dir, land_cover_file_name, block_size)
+    )
+    sample = partial(
+        window_eroded_sample,
+        file_name=file_name,
+        distance_file_name=distance_file_name,
+        region_file_name=region_file_name,
+        window_size=window_size,
+        sample_size=sample_size,
+        seed=seed,
+        unique_cells=unique_cells,
+    )
+    windows = raster_windows(file_name, block_size)
+    results = map_cells(sample, [(window,) for window in windows], backend)
+    samples = pd.concat(results)
+    if unique_cells:
+        samples = cell_representatives(samples)
+    samples = bottom_k_sample(samples, ["region_code", "lc"], sample_size)
+    samples = samples.drop("key", axis=1)
+    for lc in lcs:
+        dfr = samples[samples.lc == lc].set_index(["y", "x"])
+        print(lc, dfr.shape[0])
+        dfr = assign_region_codes(sp.osgb_to_lonlat(dfr))
+        dfr.to_parquet(
+            sampled_lc_file_path(lc, window_size, data_dir, land_cover_file_name)
+        )
 
 
 def percent_cover(dfr: pd.DataFrame, lcs: list[int]) -> pd.DataFrame:
@@ -158,28 +571,39 @@ def percent_cover(dfr: pd.DataFrame, lcs: list[int]) -> pd.DataFrame:
 
 if __name__ == "__main__":
     pass
-    # To split CEH product to tiles.
-    # cur_dir = os.getcwd()
-    # os.chdir(config['data_dir'])
-    # split_to_tiles(config['land_cover_file_name'])
-    # os.chdir(cur_dir)
     # Perform lc value counts per region
-    # dfr = ceh_tiles_region_value_counts(
+    # dfr = ceh_region_value_counts(
     #     config["data_dir"], config["land_cover_file_name"]
     # )
     # dfr.to_parquet(Path(config["data_dir"], "lc_counts_per_region.parquet"))
     dfr = pd.read_parquet(Path(config["data_dir"], "lc_counts_per_region.parquet"))
 
     """
-    # perform binary errosion on lc tiles
-    for lc in config['land_covers']:
-        ceh_tiles_binary_erosion(lc,
-                                 config['window_size'],
-                                 config['data_dir'],
-                                 config['land_cover_file_name'])
+    # distance to class edge, computed once for all window sizes
+    ceh_edge_distance(config['land_covers'],
+                      config['data_dir'],
+                      config['land_cover_file_name'])
+    ceh_distance_erosion(config['land_covers'],
+                         config['window_size'],
+                         config['data_dir'],
+                         config['land_cover_file_name'])
+    # or perform binary errosion on lc raster windows
+    ceh_binary_erosion(config['land_covers'],
+                             config['window_size'],
+                             config['data_dir'],
+                             config['land_cover_file_name'])
 
     """
-    # reproject and add UK precipitation region column
+    # sample eroded pixels per region while streaming, reproject and add
+    # UK precipitation region column to the samples only
+    """
+    ceh_sample_eroded(config['land_covers'],
+                      config['window_size'],
+                      config['sample_size'],
+                      config['data_dir'],
+                      config['land_cover_file_name'])
+    """
+    # or reproject and add UK precipitation region column to all pixels
     """
     for lc in config['land_covers']:
         file_path = eroded_lc_file_path(lc,
@@ -5,7 +5,11 @@ from pathlib import Path
 from matplotlib.ticker import FuncFormatter, MultipleLocator, AutoMinorLocator
 from matplotlib.dates import MonthLocator, num2date
 from configuration import config, ukceh_classes, color_dict
-from prepare_data import fire_phenology_file_name, phenology_quantiles_file
+from prepare_data import (
+    fire_phenology_file_name,
+    phenology_quantiles_file,
+    with_phenology_dates,
+)
 
 COLOR = "0.3"
 plt.rcParams["font.family"] = "Fira Sans"
@@ -15,7 +19,7 @@ plt.rcParams["axes.edgecolor"] = COLOR
 plt.rcParams["xtick.color"] = COLOR
 plt.rcParams["ytick.color"] = COLOR
 sns.set_context('paper')
-fire = pd.read_parquet(fire_phenology_file_name())
+fire = with_phenology_dates(pd.read_parquet(fire_phenology_file_name()))
 
 region = "South-west"
 lcw = [4, 9, 7]
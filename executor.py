@@ -0,0 +1,95 @@
+"""
+Parallel execution of independent per region and land cover work
+author: tadasnik@gmail.com
+"""
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+
+from configuration import config
+
+
+def region_lc_cells(region_first: bool = False) -> list:
+    """Return (region, lc) cells of configured regions and land covers in
+    the order of the lc (outer) / region (inner) loops, or region outer"""
+    if region_first:
+        return [
+            (region, lc) for region in config["regions"] for lc in config["land_covers"]
+        ]
+    return [
+        (region, lc) for lc in config["land_covers"] for region in config["regions"]
+    ]
+
+
+def timed_call(func, cell):
+    """Call func with cell arguments, return result and elapsed seconds"""
+    start = time.perf_counter()
+    result = func(*cell)
+    return result, time.perf_counter() - start
+
+
+def ordered_results(submit, func, cells: list, max_in_flight: int):
+    """Yield timed results of func over cells in order, keeping at most
+    max_in_flight cells submitted through submit(fn, *args) ahead"""
+    pending = deque()
+    for cell in cells:
+        pending.append(submit(timed_call, func, cell))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_cells(
+    func, cells: list, backend: str = None, max_workers: int = None, timings=None
+):
+    """
+    Yield func(*cell) for every cell in the order of cells as each one
+    finishes, using serial, thread, process or dask backend (config
+    executor by default). At most max_workers (CPU count by default)
+    cells are in flight, so only their results are held in memory while
+    the caller consumes them, a single one with the serial backend.
+    Per cell timing is printed and stored in timings dict if given.
+    func must be a module level function (or functools.partial of one)
+    for process and dask.
+    """
+    if backend is None:
+        backend = config.get("executor", "serial")
+    max_in_flight = max_workers or os.cpu_count() or 1
+    with ExitStack() as stack:
+        if backend == "serial":
+            outputs = (timed_call(func, cell) for cell in cells)
+        elif backend in ["thread", "process"]:
+            pool = ThreadPoolExecutor if backend == "thread" else ProcessPoolExecutor
+            executor = stack.enter_context(pool(max_workers=max_workers))
+            outputs = ordered_results(executor.submit, func, cells, max_in_flight)
+        elif backend == "dask":
+            from dask.distributed import Client, LocalCluster
+
+            cluster = stack.enter_context(LocalCluster(n_workers=max_workers))
+            client = stack.enter_context(Client(cluster))
+            outputs = ordered_results(
+                partial(client.submit, pure=False), func, cells, max_in_flight
+            )
+        else:
+            raise ValueError(f"Unknown executor backend {backend}")
+        for cell, (result, seconds) in zip(cells, outputs):
+            print(*cell, f"{seconds:.2f} s")
+            if timings is not None:
+                timings[cell] = seconds
+            yield result
+
+
+def map_cells(
+    func, cells: list, backend: str = None, max_workers: int = None, timings=None
+) -> list:
+    """
+    Call func(*cell) for every cell using serial, thread, process or dask
+    backend (config executor by default), see iter_cells. Results are
+    returned in the order of cells whatever order they complete in.
+    """
+    return list(iter_cells(func, cells, backend, max_workers, timings))
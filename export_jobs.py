@@ -0,0 +1,230 @@
+"""
+Orchestration of Google Earth Engine export jobs with a persisted ledger
+author: tadasnik@gmail.com
+"""
+
+import json
+import time
+import uuid
+from pathlib import Path
+
+import pandas as pd
+
+from configuration import config
+from ingest import gee_csv_file_name
+
+# Export functions of gee_data per product
+product_exports = {
+    "VNP13A1": "gee_VNP13A1_to_drive",
+    "VNP22Q2": "gee_VNP22Q2_to_drive",
+    "VNP09GA": "gee_VNP09GA_to_drive",
+    "MERIT_DEM": "MERIT_DEM_dataset",
+    "height": "vegatation_height",
+    "agb": "vegatation_agb",
+}
+
+# Task states reported by Earth Engine ending a task without its export,
+# a task with cancel requested never completes
+failed_states = ["FAILED", "CANCELLED", "CANCEL_REQUESTED"]
+
+
+def ledger_file_name():
+    file_name = Path(config["data_dir"], "gee_results", "export_ledger.json")
+    return file_name
+
+
+def job_name(product: str, region: str, lc: int) -> str:
+    return f"{product}_{region}_{lc}_sample"
+
+
+def region_lc_samples(region: str, lc: int) -> pd.DataFrame:
+    """Return sampled points of lc in region"""
+    from ceh_lc_proc import sampled_lc_file_path
+
+    sampled_file_name = sampled_lc_file_path(
+        lc, config["window_size"], config["data_dir"], config["land_cover_file_name"]
+    )
+    dfr = pd.read_parquet(sampled_file_name)
+    return dfr[dfr["Region"] == region]
+
+
+def job_samples(job: dict) -> pd.DataFrame:
+    """Return sampled points of the job, restricted to the fids or the
+    feature subset of the job if given"""
+    dfr = region_lc_samples(job["region"], job["lc"])
+    if "fids" in job:
+        dfr = dfr.loc[job["fids"]]
+    if "feature_start" in job:
+        dfr = dfr.iloc[job["feature_start"] : job["feature_end"]]
+    return dfr
+
+
+def extraction_jobs(products: list, lcs: list = None, regions: list = None) -> list:
+    """Return export jobs of products for regions and land covers (all
+    configured by default) whose CSV export does not exist yet, one job
+    per cell. Cells with more points than a single request fail on
+    submission, export_planner.planned_extraction_jobs splits them."""
+    lcs = config["land_covers"] if lcs is None else lcs
+    regions = config["regions"] if regions is None else regions
+    jobs = []
+    for product in products:
+        for lc in lcs:
+            for region in regions:
+                if gee_csv_file_name(product, region, lc).is_file():
+                    continue
+                name = job_name(product, region, lc)
+                jobs.append(
+                    {"name": name, "product": product, "region": region, "lc": lc}
+                )
+    return jobs
+
+
+class EarthEngineBackend(object):
+    """Submit export jobs as Earth Engine table exports to Drive folder
+    out_dir and report their state"""
+
+    def __init__(self, out_dir: str = "gee_results"):
+        import ee
+        import gee_data
+
+        self.ee = ee
+        self.gee_data = gee_data
+        self.out_dir = out_dir
+
+    def submit(self, job: dict) -> str:
+        """Start export of the job, restricted to the feature subset and
+        date range of chunk jobs (see export_planner) or the fids of
+        cache gap jobs (see extraction_cache). The points are sent inline,
+        raises ValueError if they do not fit in a single request."""
+        dfr = job_samples(job)
+        dates = {x: job[x] for x in ["start_date", "end_date"] if job.get(x)}
+        gee_features = self.gee_data.gee_features_from_points(dfr)
+        export = getattr(self.gee_data, product_exports[job["product"]])
+        task = export(gee_features, self.out_dir, job["name"], **dates)
+        return task.id
+
+    def status(self, task_id: str) -> tuple:
+        """Return (state, error message) of the task"""
+        status = self.ee.data.getTaskStatus(task_id)[0]
+        return status["state"], status.get("error_message")
+
+
+class LocalTaskBackend(object):
+    """
+    Local stand in for Earth Engine tasks. A task completes after duration
+    status polls. Jobs named in failures fail that many attempts first.
+    """
+
+    def __init__(self, duration: int = 2, failures: dict = None):
+        self.duration = duration
+        self.failures = {} if failures is None else dict(failures)
+        self.tasks = {}
+        self.submitted = []
+
+    def submit(self, job: dict) -> str:
+        task_id = f"local_{uuid.uuid4().hex}"
+        attempt = self.submitted.count(job["name"])
+        fail = attempt < self.failures.get(job["name"], 0)
+        self.tasks[task_id] = {"polls": 0, "fail": fail}
+        self.submitted.append(job["name"])
+        return task_id
+
+    def status(self, task_id: str) -> tuple:
+        # tasks submitted by an earlier run are taken as running fine
+        task = self.tasks.setdefault(task_id, {"polls": 0, "fail": False})
+        task["polls"] += 1
+        if task["polls"] < self.duration:
+            return "RUNNING", None
+        if task["fail"]:
+            return "FAILED", "local task failure"
+        return "COMPLETED", None
+
+
+def read_ledger(file_name) -> dict:
+    try:
+        with open(file_name) as ledger_file:
+            return json.load(ledger_file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_ledger(ledger: dict, file_name):
+    file_name = Path(file_name)
+    file_name.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file_name = file_name.with_suffix(".tmp")
+    with open(tmp_file_name, "w") as ledger_file:
+        json.dump(ledger, ledger_file, indent=1)
+    tmp_file_name.replace(file_name)
+
+
+def run_jobs(
+    jobs: list,
+    backend,
+    file_name=None,
+    max_in_flight: int = 5,
+    max_attempts: int = 3,
+    poll_interval: float = 10,
+    max_poll_interval: float = 300,
+    backoff: float = 2,
+    sleep=time.sleep,
+) -> dict:
+    """
+    Run export jobs keeping up to max_in_flight tasks submitted. Task
+    states are polled every poll_interval seconds, growing by backoff up
+    to max_poll_interval while nothing changes. Failed tasks are
+    resubmitted up to max_attempts. Job states are persisted in the ledger
+    file after every change, so a rerun skips completed jobs, resumes
+    polling tasks that were in flight and retries failed jobs with
+    attempts left (after raising max_attempts). Returns the ledger.
+    """
+    file_name = ledger_file_name() if file_name is None else file_name
+    ledger = read_ledger(file_name)
+    jobs = {job["name"]: job for job in jobs}
+    for name in jobs:
+        entry = ledger.setdefault(
+            name, {"state": "PENDING", "task_id": None, "attempts": 0, "error": None}
+        )
+        if entry["state"] == "FAILED" and entry["attempts"] < max_attempts:
+            entry["state"] = "PENDING"
+    interval = poll_interval
+    while True:
+        running = [x for x in jobs if ledger[x]["state"] == "RUNNING"]
+        pending = [x for x in jobs if ledger[x]["state"] == "PENDING"]
+        for name in pending[: max(max_in_flight - len(running), 0)]:
+            entry = ledger[name]
+            entry["task_id"] = backend.submit(jobs[name])
+            entry["attempts"] += 1
+            entry["state"] = "RUNNING"
+            running.append(name)
+            print("submitted", name, entry["attempts"])
+        write_ledger(ledger, file_name)
+        if len(running) == 0:
+            break
+        sleep(interval)
+        changed = False
+        for name in running:
+            entry = ledger[name]
+            state, error = backend.status(entry["task_id"])
+            if state == "COMPLETED":
+                entry["state"] = "COMPLETED"
+                changed = True
+                print("completed", name)
+            elif state in failed_states:
+                entry["error"] = error
+                failed = entry["attempts"] >= max_attempts
+                entry["state"] = "FAILED" if failed else "PENDING"
+                changed = True
+                print(state.lower(), name, error)
+        write_ledger(ledger, file_name)
+        interval = (
+            poll_interval if changed else min(interval * backoff, max_poll_interval)
+        )
+    return ledger
+
+
+if __name__ == "__main__":
+    pass
+    """
+    jobs = extraction_jobs(["VNP13A1", "VNP22Q2", "MERIT_DEM", "height"])
+    ledger = run_jobs(jobs, EarthEngineBackend())
+    """
@@ -0,0 +1,203 @@
+"""
+Splitting of Google Earth Engine zonal_stats exports into chunks of
+bounded size and reassembly of the chunk exports
+author: tadasnik@gmail.com
+"""
+
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from configuration import config
+from export_jobs import job_name, region_lc_samples
+from gee_features import max_request_features
+from ingest import gee_csv_file_name, ingested_file_name, read_gee_csv
+
+# Date range and image cadence (days) of exported products, products
+# without dates are single images. Yearly products start on January 1,
+# composites restart on January 1 of every year
+product_dates = {
+    "VNP13A1": {"start_date": "2012-01-01", "end_date": "2024-02-29", "days": 8},
+    "VNP22Q2": {"start_date": "2013-01-01", "end_date": "2022-01-02", "days": 365},
+    "VNP09GA": {"start_date": "2013-01-01", "end_date": "2024-09-01", "days": 1},
+    "MERIT_DEM": None,
+    "height": None,
+    "agb": None,
+}
+
+
+def image_dates(product: str, start_date: str = None, end_date: str = None):
+    """Return start dates of the product images from start_date up to
+    end_date (the product date range by default)"""
+    dates = product_dates[product]
+    start = pd.Timestamp(start_date or dates["start_date"])
+    end = pd.Timestamp(end_date or dates["end_date"])
+    years = pd.date_range(str(start.year), end, freq="YS")
+    if dates["days"] < 365:
+        years = [
+            pd.date_range(year, year + pd.offsets.YearEnd(), freq=f"{dates['days']}D")
+            for year in years
+        ]
+        years = years[0].append(years[1:])
+    return years[(years >= start) & (years < end)]
+
+
+def estimate_images(product: str, start_date: str = None, end_date: str = None):
+    """Estimate number of images of the product between the dates (the
+    product date range by default)"""
+    if product_dates[product] is None:
+        return 1
+    return len(image_dates(product, start_date, end_date))
+
+
+def estimate_rows(product: str, n_features: int) -> int:
+    """Estimate output rows (images x features) of a zonal_stats export"""
+    return estimate_images(product) * n_features
+
+
+def plan_chunks(
+    product: str,
+    n_features: int,
+    max_rows: int = None,
+    start_date: str = None,
+    end_date: str = None,
+) -> list:
+    """
+    Split export of n_features points of the product between start_date
+    and end_date (the product date range by default) into chunks with
+    estimated rows under max_rows (config max_export_rows by default) and
+    inline point footprints fitting a single request (see
+    gee_features.max_request_features). Date ranges are split first,
+    features only once a chunk is down to a single image. Returns list of
+    dicts of start_date, end_date (None for products without dates or a
+    single date chunk), feature_start and feature_end.
+    """
+    max_rows = (
+        config.get("max_export_rows", 2_000_000) if max_rows is None else max_rows
+    )
+    request_features = min(n_features, max_request_features())
+    n_images = max(estimate_images(product, start_date, end_date), 1)
+    images_per_chunk = min(max(max_rows // max(request_features, 1), 1), n_images)
+    features_per_chunk = min(max(max_rows // images_per_chunk, 1), request_features)
+    dates = product_dates[product]
+    if dates is None or images_per_chunk == n_images:
+        date_ranges = [(None, None)]
+    else:
+        start_date = start_date or dates["start_date"]
+        end_date = end_date or dates["end_date"]
+        # chunks start on image dates, so none splits or misses an image
+        edges = image_dates(product, start_date, end_date)[
+            images_per_chunk::images_per_chunk
+        ]
+        edges = [start_date] + list(edges.strftime("%Y-%m-%d")) + [end_date]
+        date_ranges = [
+            (start, end) for start, end in zip(edges[:-1], edges[1:]) if start < end
+        ]
+    chunks = []
+    for start_date, end_date in date_ranges:
+        for feature_start in range(0, n_features, features_per_chunk):
+            chunks.append(
+                {
+                    "start_date": start_date,
+                    "end_date": end_date,
+                    "feature_start": feature_start,
+                    "feature_end": min(feature_start + features_per_chunk, n_features),
+                }
+            )
+    return chunks
+
+
+def chunk_jobs(
+    product: str, region: str, lc: int, n_features: int, max_rows: int = None
+) -> list:
+    """Return export jobs of the planned chunks of product, region and lc
+    for export_jobs.run_jobs"""
+    name = job_name(product, region, lc)
+    chunks = plan_chunks(product, n_features, max_rows)
+    if len(chunks) == 1:
+        return [{"name": name, "product": product, "region": region, "lc": lc}]
+    return [
+        {
+            "name": f"{name}_{nr:03d}",
+            "product": product,
+            "region": region,
+            "lc": lc,
+            **chunk,
+        }
+        for nr, chunk in enumerate(chunks)
+    ]
+
+
+def planned_extraction_jobs(
+    products: list, lcs: list = None, regions: list = None, max_rows: int = None
+) -> list:
+    """Return chunked export jobs of products for regions and land covers
+    (all configured by default) whose typed parquet, CSV export or chunk
+    CSV exports do not exist yet"""
+    lcs = config["land_covers"] if lcs is None else lcs
+    regions = config["regions"] if regions is None else regions
+    jobs = []
+    for product in products:
+        for lc in lcs:
+            for region in regions:
+                if ingested_file_name(product, region, lc).is_file():
+                    continue
+                if gee_csv_file_name(product, region, lc).is_file():
+                    continue
+                n_features = len(region_lc_samples(region, lc))
+                if n_features == 0:
+                    continue
+                cell_jobs = chunk_jobs(product, region, lc, n_features, max_rows)
+                if all(chunk_csv_file_name(x["name"]).is_file() for x in cell_jobs):
+                    continue
+                jobs += cell_jobs
+    return jobs
+
+
+def chunk_csv_file_name(name: str):
+    file_name = Path(config["data_dir"], "gee_results", f"{name}.csv")
+    return file_name
+
+
+def assemble_chunks(product: str, region: str, lc: int, jobs: list):
+    """
+    Combine CSV exports of the chunk jobs of product, region and lc into
+    one typed parquet (see ingest.read_gee_table). Raises
+    FileNotFoundError if a chunk export is missing.
+    """
+    names = [
+        job["name"]
+        for job in jobs
+        if (job["product"], job["region"], job["lc"]) == (product, region, lc)
+    ]
+    tables = [read_gee_csv(chunk_csv_file_name(name), product) for name in names]
+    table = pa.concat_tables(tables, promote_options="permissive")
+    out_file_name = ingested_file_name(product, region, lc)
+    out_file_name.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, out_file_name)
+    return out_file_name
+
+
+def assemble_jobs(jobs: list):
+    """Assemble chunk exports of all product, region and lc of jobs"""
+    cells = {(job["product"], job["region"], job["lc"]) for job in jobs}
+    for product, region, lc in sorted(cells):
+        try:
+            assemble_chunks(product, region, lc, jobs)
+        except FileNotFoundError:
+            print("missing chunk exports", product, region, lc)
+            continue
+
+
+if __name__ == "__main__":
+    pass
+    """
+    from export_jobs import EarthEngineBackend, run_jobs
+
+    jobs = planned_extraction_jobs(["VNP13A1", "VNP22Q2", "MERIT_DEM", "height"])
+    ledger = run_jobs(jobs, EarthEngineBackend())
+    # after copying the exports from Drive to gee_results
+    assemble_jobs(jobs)
+    """
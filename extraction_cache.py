@@ -0,0 +1,310 @@
+"""
+Content addressed cache of Google Earth Engine point extractions
+author: tadasnik@gmail.com
+"""
+
+import json
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from configuration import config
+from export_jobs import region_lc_samples
+from export_planner import chunk_csv_file_name, plan_chunks
+from ingest import phenology_columns, read_gee_csv
+
+# Collection, bands, reducer and scale of extracted products
+product_extractions = {
+    "VNP13A1": {
+        "collection": "NOAA/VIIRS/001/VNP13A1",
+        "bands": ["EVI2", "NDVI", "pixel_reliability", "composite_day_of_the_year"],
+        "reducer": "first",
+        "scale": 500,
+    },
+    "VNP22Q2": {
+        "collection": "NOAA/VIIRS/001/VNP22Q2",
+        "bands": phenology_columns,
+        "reducer": "first",
+        "scale": 500,
+    },
+    "VNP09GA": {
+        "collection": "NASA/VIIRS/002/VNP09GA",
+        "bands": ["ndmi"],
+        "reducer": "mean",
+        "scale": 1000,
+    },
+}
+
+
+def cache_dir():
+    dir_name = Path(config["data_dir"], "gee_results", "cache")
+    return dir_name
+
+
+def point_ids(longitude, latitude) -> np.ndarray:
+    """Return int64 ids of points from their coordinates rounded to 1e-6
+    degrees, identical points get the same id whatever sample they are in"""
+    lon = np.rint((np.asarray(longitude) + 180) * 1e6).astype(np.int64)
+    lat = np.rint((np.asarray(latitude) + 90) * 1e6).astype(np.int64)
+    return lon * 1_000_000_000 + lat
+
+
+def points_hash(ids) -> str:
+    """Return hash of a set of point ids"""
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    return hashlib.blake2b(ids.tobytes(), digest_size=8).hexdigest()
+
+
+def year_start(year: int) -> pd.Timestamp:
+    return pd.Timestamp(year=year, month=1, day=1)
+
+
+class ExtractionCache(object):
+    """
+    Extraction results of a collection, band list, reducer and scale,
+    stored under a key hashed from these, partitioned by year. Coverage
+    of every point (by coordinates) and year is recorded as the extracted
+    date intervals, so only the missing point and date range gaps need
+    to be requested.
+    """
+
+    def __init__(self, collection: str, bands: list, reducer: str, scale: float):
+        self.spec = {
+            "collection": collection,
+            "bands": list(bands),
+            "reducer": reducer,
+            "scale": scale,
+        }
+        spec = json.dumps(self.spec, sort_keys=True).encode()
+        self.key = hashlib.blake2b(spec, digest_size=16).hexdigest()
+        self.dir = Path(cache_dir(), self.key)
+
+    @classmethod
+    def for_product(cls, product: str):
+        return cls(**product_extractions[product])
+
+    def partition_dir(self, year: int):
+        return Path(self.dir, f"year={year}")
+
+    def coverage_file_name(self):
+        return Path(self.dir, "coverage.parquet")
+
+    def coverage(self) -> pd.DataFrame:
+        """Return extracted date intervals (start_date, exclusive end_date)
+        per point_id and year, sorted and not overlapping"""
+        try:
+            return pd.read_parquet(self.coverage_file_name())
+        except FileNotFoundError:
+            return pd.DataFrame(
+                {
+                    "point_id": np.array([], dtype=np.int64),
+                    "year": np.array([], dtype=np.int64),
+                    "start_date": pd.to_datetime([]),
+                    "end_date": pd.to_datetime([]),
+                }
+            )
+
+    def gaps(self, dfr: pd.DataFrame, start_date: str, end_date: str) -> list:
+        """
+        Return missing extractions of points in dfr (longitude, latitude
+        columns) between start_date and (exclusive) end_date as list of
+        dicts of start_date, end_date and fids (dfr index values). Gaps
+        are the parts of the requested dates of every year outside the
+        extracted intervals of the point. Points missing the same dates
+        are requested together and consecutive gaps of the same points
+        are merged into one date range.
+        """
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        ids = point_ids(dfr.longitude, dfr.latitude)
+        unique_ids = np.unique(ids)
+        years = np.arange(start.year, (end - pd.Timedelta(days=1)).year + 1)
+        starts = pd.to_datetime([max(year_start(x), start) for x in years])
+        ends = pd.to_datetime([min(year_start(x + 1), end) for x in years])
+        grid = pd.DataFrame(
+            {
+                "point_id": np.repeat(unique_ids, len(years)),
+                "year": np.tile(years, len(unique_ids)),
+                "request_start": np.tile(starts.to_numpy(), len(unique_ids)),
+                "request_end": np.tile(ends.to_numpy(), len(unique_ids)),
+            }
+        )
+        keys = ["point_id", "year"]
+        grid = grid.merge(self.coverage(), on=keys, how="left")
+        grid = grid.sort_values(keys + ["start_date"], ignore_index=True)
+        # gaps before every interval, the whole request where not covered
+        before = grid[["point_id", "request_start", "request_end"]].copy()
+        before["start"] = grid.groupby(keys)["end_date"].shift()
+        before["start"] = before.start.fillna(grid.request_start)
+        before["end"] = grid.start_date.fillna(grid.request_end)
+        # gaps after the last interval
+        last = grid.dropna(subset=["end_date"]).groupby(keys, as_index=False).last()
+        after = last[["point_id", "request_start", "request_end"]].copy()
+        after["start"] = last.end_date
+        after["end"] = last.request_end
+        grid = pd.concat([before, after], ignore_index=True)
+        grid["start"] = np.maximum(grid.start, grid.request_start)
+        grid["end"] = np.minimum(grid.end, grid.request_end)
+        grid = grid[grid.start < grid.end]
+        requests = []
+        for (gap_start, gap_end), sub in grid.groupby(["start", "end"]):
+            requests.append([points_hash(sub.point_id), gap_start, gap_end, sub])
+        requests.sort(key=lambda x: (x[0], x[1]))
+        merged = []
+        for request in requests:
+            last = merged[-1] if merged else None
+            if last and last[0] == request[0] and last[2] == request[1]:
+                last[2] = request[2]
+            else:
+                merged.append(request)
+        merged.sort(key=lambda x: x[1])
+        return [
+            {
+                "start_date": gap_start.strftime("%Y-%m-%d"),
+                "end_date": gap_end.strftime("%Y-%m-%d"),
+                "fids": dfr.index[np.isin(ids, sub.point_id)].tolist(),
+            }
+            for _, gap_start, gap_end, sub in merged
+        ]
+
+    def store(self, dfr: pd.DataFrame, results: pd.DataFrame, start_date, end_date):
+        """
+        Store extraction results (date, fid and band columns) of points in
+        dfr between start_date and (exclusive) end_date as a new part of
+        each year partition, and add the interval to the coverage.
+        """
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        ids = pd.Series(point_ids(dfr.longitude, dfr.latitude), index=dfr.index)
+        res = results.drop(columns="fid")
+        res["point_id"] = ids.reindex(results["fid"]).to_numpy()
+        part = f"{points_hash(ids)}_{start:%Y%m%d}_{end:%Y%m%d}.parquet"
+        for year, sub in res.groupby(pd.to_datetime(res["date"]).dt.year):
+            self.partition_dir(year).mkdir(parents=True, exist_ok=True)
+            sub.to_parquet(Path(self.partition_dir(year), part), index=False)
+        years = np.arange(start.year, (end - pd.Timedelta(days=1)).year + 1)
+        starts = pd.to_datetime([max(year_start(x), start) for x in years])
+        ends = pd.to_datetime([min(year_start(x + 1), end) for x in years])
+        unique_ids = np.unique(ids.to_numpy())
+        coverage = pd.DataFrame(
+            {
+                "point_id": np.repeat(unique_ids, len(years)),
+                "year": np.tile(years, len(unique_ids)),
+                "start_date": np.tile(starts.to_numpy(), len(unique_ids)),
+                "end_date": np.tile(ends.to_numpy(), len(unique_ids)),
+            }
+        )
+        coverage = merge_intervals(pd.concat([self.coverage(), coverage]))
+        self.dir.mkdir(parents=True, exist_ok=True)
+        coverage.to_parquet(self.coverage_file_name(), index=False)
+        with open(Path(self.dir, "spec.json"), "w") as spec_file:
+            json.dump(self.spec, spec_file)
+
+    def read(self, dfr: pd.DataFrame, start_date, end_date) -> pd.DataFrame:
+        """Return cached results of points in dfr between start_date and
+        (exclusive) end_date with dfr index values as fid, rows of points
+        sampled more than once are repeated for each fid. Missing dates
+        (see gaps) are reported"""
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        fids = pd.DataFrame(
+            {"point_id": point_ids(dfr.longitude, dfr.latitude), "fid": dfr.index}
+        )
+        missing = self.gaps(dfr, start_date, end_date)
+        if len(missing) > 0:
+            print("cache gaps", [(x["start_date"], x["end_date"]) for x in missing])
+        years = np.arange(start.year, (end - pd.Timedelta(days=1)).year + 1)
+        parts = []
+        for year in years:
+            for file_name in sorted(self.partition_dir(year).glob("*.parquet")):
+                part = pd.read_parquet(file_name)
+                parts.append(part[part.point_id.isin(fids.point_id)])
+        if len(parts) == 0:
+            return pd.DataFrame()
+        res = pd.concat(parts, ignore_index=True)
+        dates = pd.to_datetime(res["date"])
+        res = res[(dates >= start) & (dates < end)]
+        res = fids.merge(res, on="point_id")
+        return res.drop(columns="point_id")
+
+
+def merge_intervals(coverage: pd.DataFrame) -> pd.DataFrame:
+    """Merge overlapping or touching date intervals of coverage per
+    point_id and year"""
+    keys = ["point_id", "year"]
+    coverage = coverage.sort_values(keys + ["start_date"], ignore_index=True)
+    reach = coverage.groupby(keys)["end_date"].cummax()
+    previous_reach = reach.groupby([coverage.point_id, coverage.year]).shift()
+    new_interval = ~(coverage.start_date <= previous_reach)
+    coverage["interval"] = new_interval.cumsum()
+    coverage = coverage.groupby(keys + ["interval"], as_index=False).agg(
+        start_date=("start_date", "min"), end_date=("end_date", "max")
+    )
+    return coverage.drop(columns="interval")
+
+
+def cached_extraction_jobs(
+    product: str,
+    start_date: str,
+    end_date: str,
+    lcs: list = None,
+    regions=None,
+    max_rows: int = None,
+) -> list:
+    """Return export jobs (see export_jobs.run_jobs) of the points and date
+    ranges of the product not in the extraction cache, every gap split
+    into chunks of estimated rows under max_rows (see
+    export_planner.plan_chunks)"""
+    cache = ExtractionCache.for_product(product)
+    lcs = config["land_covers"] if lcs is None else lcs
+    regions = config["regions"] if regions is None else regions
+    jobs = []
+    for lc in lcs:
+        for region in regions:
+            dfr = region_lc_samples(region, lc)
+            for gap in cache.gaps(dfr, start_date, end_date):
+                fids = gap["fids"]
+                dates = f"{gap['start_date']}_{gap['end_date']}"
+                name = f"{product}_{region}_{lc}_{dates}_{points_hash(fids)[:8]}"
+                chunks = plan_chunks(
+                    product, len(fids), max_rows, gap["start_date"], gap["end_date"]
+                )
+                for nr, chunk in enumerate(chunks):
+                    jobs.append(
+                        {
+                            "name": f"{name}_{nr:03d}",
+                            "product": product,
+                            "region": region,
+                            "lc": lc,
+                            "start_date": chunk["start_date"] or gap["start_date"],
+                            "end_date": chunk["end_date"] or gap["end_date"],
+                            "fids": fids[chunk["feature_start"] : chunk["feature_end"]],
+                        }
+                    )
+    return jobs
+
+
+def store_jobs(jobs: list):
+    """Store CSV exports of completed cached_extraction_jobs in the cache"""
+    for job in jobs:
+        try:
+            table = read_gee_csv(chunk_csv_file_name(job["name"]), job["product"])
+        except FileNotFoundError:
+            print("missing export", job["name"])
+            continue
+        dfr = region_lc_samples(job["region"], job["lc"]).loc[job["fids"]]
+        cache = ExtractionCache.for_product(job["product"])
+        cache.store(dfr, table.to_pandas(), job["start_date"], job["end_date"])
+
+
+if __name__ == "__main__":
+    pass
+    """
+    from export_jobs import EarthEngineBackend, run_jobs
+
+    jobs = cached_extraction_jobs("VNP13A1", "2012-01-01", "2025-01-01")
+    ledger = run_jobs(jobs, EarthEngineBackend())
+    # after copying the exports from Drive to gee_results
+    store_jobs(jobs)
+    dfr = region_lc_samples("Central", 4)
+    evi = ExtractionCache.for_product("VNP13A1").read(dfr, "2012-01-01", "2025-01-01")
+    """
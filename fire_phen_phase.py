@@ -7,7 +7,11 @@ from pathlib import Path
 from matplotlib.ticker import FuncFormatter
 from matplotlib.dates import MonthLocator, num2date
 from configuration import config, ukceh_classes_n, color_dict
-from prepare_data import fire_phenology_file_name, phenology_quantiles_file
+from prepare_data import (
+    fire_phenology_file_name,
+    phenology_quantiles_file,
+    with_phenology_dates,
+)
 
 COLOR = "0.3"
 plt.rcParams["font.family"] = "Fira Sans"
@@ -74,10 +78,10 @@ def phenology_fire_size(fire):
                     )
                 durations.append(duration)
             subg = (
-                sub.groupby(["season", "event"])["size"]
+                sub.groupby(["season", "event"], observed=True)["size"]
                 .first()
                 .reset_index()
-                .groupby("season")["size"]
+                .groupby("season", observed=True)["size"]
                 .mean()[hue_order]
                 .values
             )
@@ -182,7 +186,7 @@ def phenology_fire_rates(fire):
                         sub[date_cols[nr]].median() - sub[date_cols[nr - 1]].median()
                     )
                 durations.append(duration)
-            subg = sub.groupby("season")["lc"].count()[hue_order].values
+            subg = sub.groupby("season", observed=True)["lc"].count()[hue_order].values
             rates = (subg / np.array(durations)) / 11
             color = (color_dict[lc],)
             bars = ax_col.bar(range(6), rates, color=color)
@@ -225,5 +229,5 @@ def phenology_fire_rates(fire):
     plt.show()
 
 
-fire = pd.read_parquet(fire_phenology_file_name())
+fire = with_phenology_dates(pd.read_parquet(fire_phenology_file_name()))
 phenology_fire_size(fire)
@@ -14,6 +14,7 @@ from pathlib import Path
 from rclone_python import rclone
 
 from ceh_lc_proc import sampled_lc_file_path
+from gee_features import gee_features_from_points
 
 # ee.Authenticate()
 ee.Initialize()
@@ -149,23 +150,14 @@ def zonal_stats(ic, fc, params=None):
     return results
 
 
-def gee_features_from_points(dfr):
-    features = []
-    for ind, row in dfr.iterrows():
-        geom = (
-            ee.Feature(ee.Geometry.Point([row.longitude, row.latitude]), {"fid": ind})
-            .buffer(20)
-            .bounds()
-        )
-        features.append(geom)
-    gee_features = ee.FeatureCollection(features)
-    return gee_features
-
-
-def gee_VNP09GA_to_drive(gee_features, out_dir, file_name, selectors):
-
-    start_date = "2013-01-01"
-    end_date = "2024-09-01"
+def gee_VNP09GA_to_drive(
+    gee_features,
+    out_dir,
+    file_name,
+    selectors=None,
+    start_date="2013-01-01",
+    end_date="2024-09-01",
+):
     viirsCollection = (
         ee.ImageCollection("NASA/VIIRS/002/VNP09GA")
         .filterDate(start_date, end_date)
@@ -193,9 +185,12 @@ def gee_VNP09GA_to_drive(gee_features, out_dir, file_name, selectors):
         }
     )
     task.start()
+    return task
 
 
-def gee_VNP13A1_to_drive(gee_features, out_dir, file_name):
+def gee_VNP13A1_to_drive(
+    gee_features, out_dir, file_name, start_date="2012-01-01", end_date="2024-02-29"
+):
     bands = ["EVI2", "NDVI", "pixel_reliability", "composite_day_of_the_year"]
     params = {
         "reducer": ee.Reducer.first(),
@@ -205,8 +200,6 @@ def gee_VNP13A1_to_drive(gee_features, out_dir, file_name):
         "datetimeFormat": "YYYY-MM-dd",
     }
     collection_evi = ee.ImageCollection("NOAA/VIIRS/001/VNP13A1")
-    start_date = "2012-01-01"
-    end_date = "2024-02-29"
     filt_collection = collection_evi.filterDate(start_date, end_date).filterBounds(
         gee_features.geometry()
     )
@@ -222,9 +215,12 @@ def gee_VNP13A1_to_drive(gee_features, out_dir, file_name):
         }
     )
     task.start()
+    return task
 
 
-def gee_VNP22Q2_to_drive(gee_features, out_dir, file_name):
+def gee_VNP22Q2_to_drive(
+    gee_features, out_dir, file_name, start_date="2013-01-01", end_date="2022-01-02"
+):
     phen_columns = [
         "Onset_Greenness_Increase_1",
         "Onset_Greenness_Maximum_1",
@@ -245,8 +241,6 @@ def gee_VNP22Q2_to_drive(gee_features, out_dir, file_name):
         "datetimeFormat": "YYYY-MM-dd",
     }
     collection = ee.ImageCollection("NOAA/VIIRS/001/VNP22Q2")
-    start_date = "2013-01-01"
-    end_date = "2022-01-02"
     filt_collection = collection.filterDate(start_date, end_date).filterBounds(
         gee_features.geometry()
     )
@@ -261,6 +255,7 @@ def gee_VNP22Q2_to_drive(gee_features, out_dir, file_name):
         }
     )
     task.start()
+    return task
 
 
 def MERIT_DEM_dataset(gee_features, out_dir, file_name):
@@ -296,6 +291,7 @@ def MERIT_DEM_dataset(gee_features, out_dir, file_name):
         }
     )
     task.start()
+    return task
 
 
 def vegatation_agb(gee_features, out_dir, file_name):
@@ -313,6 +309,7 @@ def vegatation_agb(gee_features, out_dir, file_name):
         }
     )
     task.start()
+    return task
 
 
 def vegatation_height(gee_features, out_dir, file_name):
@@ -332,6 +329,7 @@ def vegatation_height(gee_features, out_dir, file_name):
         }
     )
     task.start()
+    return task
 
 
 def wait_for_gee_file():
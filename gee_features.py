@@ -0,0 +1,162 @@
+"""
+Construction of Google Earth Engine feature collections from sample points.
+Footprints and GeoJSON are built locally, the ee module is only imported
+by the functions wrapping the results, so the module (e.g. EARTH_RADIUS)
+can be used without earthengine-api.
+author: tadasnik@gmail.com
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+
+# Radius (m) of the sphere ee.Geometry.buffer works on
+EARTH_RADIUS = 6378137.0
+
+# Payload limit (bytes) of a single inline GeoJSON feature collection
+MAX_REQUEST_BYTES = 5_000_000
+
+# Decimals of serialised footprint coordinates, 1e-6 degrees is ~0.1 m
+COORDINATE_DECIMALS = 6
+
+
+def point_footprints(longitude, latitude, half_size: float = 20.0) -> np.ndarray:
+    """
+    Return closed square rings (n, 5, 2) of lon, lat coordinates around the
+    points extending half_size metres in every direction, the local
+    equivalent of ee.Geometry.Point(...).buffer(half_size).bounds()
+    """
+    longitude = np.asarray(longitude, dtype=float)
+    latitude = np.asarray(latitude, dtype=float)
+    dlat = np.degrees(half_size / EARTH_RADIUS)
+    dlon = np.degrees(half_size / (EARTH_RADIUS * np.cos(np.radians(latitude))))
+    west, east = longitude - dlon, longitude + dlon
+    south, north = latitude - dlat, latitude + dlat
+    rings = np.stack(
+        [
+            np.stack([west, south], axis=-1),
+            np.stack([east, south], axis=-1),
+            np.stack([east, north], axis=-1),
+            np.stack([west, north], axis=-1),
+            np.stack([west, south], axis=-1),
+        ],
+        axis=1,
+    )
+    return rings
+
+
+def footprint_features(dfr: pd.DataFrame, half_size: float = 20.0) -> list:
+    """Return GeoJSON polygon features of point footprints with the dfr
+    index as fid property, coordinates rounded to COORDINATE_DECIMALS"""
+    rings = point_footprints(dfr.longitude, dfr.latitude, half_size)
+    rings = np.round(rings, COORDINATE_DECIMALS).tolist()
+    return [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {"fid": fid},
+        }
+        for ring, fid in zip(rings, dfr.index.tolist())
+    ]
+
+
+def max_request_features(
+    half_size: float = 20.0, max_bytes: int = MAX_REQUEST_BYTES
+) -> int:
+    """Return number of footprint features fitting in a max_bytes request,
+    sized by a feature with the longest coordinates and fid"""
+    worst = pd.DataFrame(
+        {"longitude": [-179.123456], "latitude": [-89.123456]}, index=[10**12]
+    )
+    feature = footprint_features(worst, half_size)[0]
+    return max(max_bytes // (len(json.dumps(feature)) + 2), 1)
+
+
+def feature_collection_chunks(
+    dfr: pd.DataFrame, half_size: float = 20.0, max_bytes: int = MAX_REQUEST_BYTES
+) -> list:
+    """Return GeoJSON FeatureCollection dicts of point footprints, split
+    in chunks of equal number of features each under max_bytes"""
+    features = footprint_features(dfr, half_size)
+    if len(features) == 0:
+        return []
+    size = len(json.dumps({"type": "FeatureCollection", "features": features}))
+    n_chunks = int(np.ceil(size / max_bytes))
+    chunk_size = int(np.ceil(len(features) / n_chunks))
+    return [
+        {"type": "FeatureCollection", "features": features[nr : nr + chunk_size]}
+        for nr in range(0, len(features), chunk_size)
+    ]
+
+
+def gee_feature_chunks(
+    dfr: pd.DataFrame, half_size: float = 20.0, max_bytes: int = MAX_REQUEST_BYTES
+) -> list:
+    """Return ee.FeatureCollections of point footprints, one per request
+    sized chunk"""
+    import ee
+
+    return [
+        ee.FeatureCollection(chunk)
+        for chunk in feature_collection_chunks(dfr, half_size, max_bytes)
+    ]
+
+
+def gee_features_from_points(dfr: pd.DataFrame, half_size: float = 20.0):
+    """
+    Return ee.FeatureCollection of half_size m square footprints around
+    points in dfr (longitude, latitude columns) with dfr index as fid.
+    Raises ValueError if the points do not fit in a single request, split
+    them (see export_planner.plan_chunks) or stage them as table assets.
+    """
+    import ee
+
+    chunks = gee_feature_chunks(dfr, half_size)
+    if len(chunks) > 1:
+        raise ValueError(
+            f"{len(dfr)} points exceed a single request, split them in chunks"
+            f" of up to {max_request_features(half_size)} points"
+        )
+    return chunks[0] if chunks else ee.FeatureCollection([])
+
+
+def stage_points_table(
+    dfr: pd.DataFrame,
+    asset_id: str,
+    half_size: float = 20.0,
+    max_bytes: int = MAX_REQUEST_BYTES,
+) -> tuple:
+    """
+    Export point footprints to Earth Engine table assets (asset_id, or
+    asset_id_{nr} if more than one request sized chunk is needed), so
+    later requests reference the points by ID. Returns asset ids and the
+    started export tasks.
+    """
+    import ee
+
+    chunks = gee_feature_chunks(dfr, half_size, max_bytes)
+    asset_ids = [asset_id] if len(chunks) == 1 else []
+    if len(chunks) > 1:
+        asset_ids = [f"{asset_id}_{nr}" for nr in range(len(chunks))]
+    tasks = []
+    for chunk, chunk_asset_id in zip(chunks, asset_ids):
+        task = ee.batch.Export.table.toAsset(
+            collection=chunk,
+            description=chunk_asset_id.split("/")[-1],
+            assetId=chunk_asset_id,
+        )
+        task.start()
+        tasks.append(task)
+    return asset_ids, tasks
+
+
+def gee_features_from_assets(asset_ids: list):
+    """Return ee.FeatureCollection of staged point table assets"""
+    import ee
+
+    if len(asset_ids) == 1:
+        return ee.FeatureCollection(asset_ids[0])
+    return ee.FeatureCollection(
+        [ee.FeatureCollection(asset_id) for asset_id in asset_ids]
+    ).flatten()
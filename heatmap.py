@@ -1,15 +1,18 @@
 import numpy as np
 import pandas as pd
+from functools import partial
 import seaborn as sns
 import matplotlib.pyplot as plt
 from pathlib import Path
 from scipy import stats
 from configuration import config
+from executor import map_cells, region_lc_cells
 from prepare_data import (
     fwi_quantiles_monthly_file_name,
     fire_phenology_file_name,
     fwi_file_name,
     fwi_phen_phase_file,
+    fwi_phen_phase_lc,
     phenology_quantiles_file,
     evi2_phen_phase_file,
 )
@@ -107,11 +110,10 @@ def scatterplot_():
         ]
         evi_dfr = evi_p[(evi_p.lc == lc) & (evi_p.Region.isin(regions))]
         evi_dfr = evi_dfr.set_index(["Region", season_col, "year"])
-        fwi_dfr = (
-            fwi_p[(fwi_p.lc == lc) & (fwi_p.Region.isin(regions))]
-            .groupby(["Region", season_col, "year"])[variables]
-            .quantile(0.95)
-        )
+        fwi_lc = fwi_phen_phase_lc(fwi_p[fwi_p.Region.isin(regions)], lc)
+        fwi_dfr = fwi_lc.groupby(["Region", season_col, "year"], observed=True)[
+            variables
+        ].quantile(0.95)
         variables += ["EVI2"]
         fwi_dfr = pd.merge(
             fwi_dfr, evi_dfr, left_index=True, right_index=True, how="left"
@@ -120,12 +122,12 @@ def scatterplot_():
         fire_s = fires[
             (fires.lc == lc) & (fires.year != 2023) & (fires.Region.isin(regions))
         ]
-        days = (
-            fwi_p[(fwi_p.lc == lc) & (fwi_p.Region.isin(regions))]
-            .groupby(["Region", season_col, "year"])["doy"]
-            .nunique()
-        )
-        fire_counts = fire_s.groupby(["Region", season_col, "year"])["frp"].count()
+        days = fwi_lc.groupby(["Region", season_col, "year"], observed=True)[
+            "doy"
+        ].nunique()
+        fire_counts = fire_s.groupby(["Region", season_col, "year"], observed=True)[
+            "frp"
+        ].count()
         y = pd.merge(
             days, fire_counts, left_index=True, right_index=True, how="outer"
         ).fillna(0)
@@ -137,63 +139,62 @@ def scatterplot_():
         ).fillna(0)
 
 
-def spearmanr_correlation_phenology(evi_p, fwi_p, fires):
+def spearmanr_correlation_phenology(evi_p, fwi_p, fires, backend=None):
     """Calculate spearman correlation values for region/predictor combinations"""
+    cell_results = map_cells(
+        partial(spearmanr_correlation_cell, evi_p=evi_p, fwi_p=fwi_p, fires=fires),
+        region_lc_cells(region_first=True),
+        backend,
+    )
     results = {}
-    for region in config["regions"]:
-        for lc in config["land_covers"]:
-            season_col = "season"
-            variables = [
-                "drtcode",
-                "dufmcode",
-                "ffmcode",
-                "fwinx",
-                "fbupinx",
-                "infsinx",
-            ]
-            evi_dfr = evi_p[(evi_p.lc == lc) & (evi_p.Region == region)]
-            evi_dfr = evi_dfr.set_index(["season", "year"])
-            fwi_dfr = (
-                fwi_p[(fwi_p.lc == lc) & (fwi_p.Region == region)]
-                .groupby([season_col, "year"])[variables]
-                .quantile(0.95)
-            )
-            variables += ["EVI2"]
-            fwi_dfr = pd.merge(
-                fwi_dfr, evi_dfr, left_index=True, right_index=True, how="left"
-            )
-            fwi_dfr["EVI2"] *= 0.0001
-            fire_s = fires[
-                (fires.Region == region) & (fires.lc == lc) & (fires.year != 2023)
-            ]
-            days = (
-                fwi_p[(fwi_p.lc == lc) & (fwi_p.Region == region)]
-                .groupby([season_col, "year"])["doy"]
-                .nunique()
-            )
-            fire_counts = fire_s.groupby([season_col, "year"])["frp"].count()
-            y = pd.merge(
-                days, fire_counts, left_index=True, right_index=True, how="outer"
-            ).fillna(0)
-            y["frp"] = y.frp.div(y.doy).replace(np.inf, 0)
-            y = y[y.doy > 28]
-            y.name = "frp"
-            xy = pd.merge(
-                fwi_dfr, y, left_index=True, right_index=True, how="outer"
-            ).fillna(0)
-            for variable in variables:
-                for season in xy.index.get_level_values(0).unique():
-                    xy_sub = xy.loc[(season), slice(None), slice(None)]
-                    if xy_sub["frp"].max() > 0:
-                        st = stats.spearmanr(
-                            xy_sub[variable].values, xy_sub["frp"].values
-                        )
-                        results[(region, lc, season, variable)] = [
-                            st.statistic,
-                            st.pvalue,
-                        ]
-                    else:
-                        results[(region, lc, season, variable)] = [0.0, 1.0]
+    for cell_result in cell_results:
+        results.update(cell_result)
+    return results
+
+
+def spearmanr_correlation_cell(region, lc, evi_p, fwi_p, fires):
+    """Calculate spearman correlation values per phenology phase and
+    predictor for region and lc"""
+    results = {}
+    season_col = "season"
+    variables = [
+        "drtcode",
+        "dufmcode",
+        "ffmcode",
+        "fwinx",
+        "fbupinx",
+        "infsinx",
+    ]
+    evi_dfr = evi_p[(evi_p.lc == lc) & (evi_p.Region == region)]
+    evi_dfr = evi_dfr.set_index(["season", "year"])
+    fwi_lc = fwi_phen_phase_lc(fwi_p[fwi_p.Region == region], lc)
+    fwi_dfr = fwi_lc.groupby([season_col, "year"], observed=True)[variables].quantile(
+        0.95
+    )
+    variables += ["EVI2"]
+    fwi_dfr = pd.merge(fwi_dfr, evi_dfr, left_index=True, right_index=True, how="left")
+    fwi_dfr["EVI2"] *= 0.0001
+    fire_s = fires[(fires.Region == region) & (fires.lc == lc) & (fires.year != 2023)]
+    days = fwi_lc.groupby([season_col, "year"], observed=True)["doy"].nunique()
+    fire_counts = fire_s.groupby([season_col, "year"], observed=True)["frp"].count()
+    y = pd.merge(
+        days, fire_counts, left_index=True, right_index=True, how="outer"
+    ).fillna(0)
+    y["frp"] = y.frp.div(y.doy).replace(np.inf, 0)
+    y = y[y.doy > 28]
+    y.name = "frp"
+    xy = pd.merge(fwi_dfr, y, left_index=True, right_index=True, how="outer").fillna(0)
+    for variable in variables:
+        for season in xy.index.get_level_values(0).unique():
+            xy_sub = xy.loc[(season), slice(None), slice(None)]
+            if xy_sub["frp"].max() > 0:
+                st = stats.spearmanr(xy_sub[variable].values, xy_sub["frp"].values)
+                results[(region, lc, season, variable)] = [
+                    st.statistic,
+                    st.pvalue,
+                ]
+            else:
+                results[(region, lc, season, variable)] = [0.0, 1.0]
     return results
 
 
@@ -0,0 +1,172 @@
+"""
+Conversion of Google Earth Engine CSV exports to typed parquet files
+author: tadasnik@gmail.com
+"""
+
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from configuration import config
+from executor import map_cells, region_lc_cells
+
+phenology_columns = [
+    "Onset_Greenness_Increase_1",
+    "Onset_Greenness_Maximum_1",
+    "Onset_Greenness_Decrease_1",
+    "Onset_Greenness_Minimum_1",
+    "Date_Mid_Greenup_Phase_1",
+    "Date_Mid_Senescence_Phase_1",
+    "EVI2_Growing_Season_Area_1",
+    "Growing_Season_Length_1",
+    "EVI2_Onset_Greenness_Increase_1",
+    "EVI2_Onset_Greenness_Maximum_1",
+]
+
+# Column types of GEE exports per product, columns not listed are inferred
+product_schemas = {
+    "VNP13A1": {
+        "date": pa.timestamp("ms"),
+        "timestamp": pa.int64(),
+        "fid": pa.int64(),
+        "EVI2": pa.int16(),
+        "NDVI": pa.int16(),
+        "pixel_reliability": pa.int8(),
+        "composite_day_of_the_year": pa.int16(),
+    },
+    "VNP22Q2": {
+        "date": pa.timestamp("ms"),
+        "timestamp": pa.int64(),
+        "fid": pa.int64(),
+        **{column: pa.float64() for column in phenology_columns},
+    },
+    "VNP09GA": {
+        "date": pa.timestamp("ms"),
+        "fid": pa.int64(),
+        "ndmi": pa.float64(),
+    },
+    "MERIT_DEM": {
+        "date": pa.timestamp("ms"),
+        "fid": pa.int64(),
+        "elevation": pa.float64(),
+        "slope": pa.float64(),
+    },
+    "height": {"fid": pa.int64(), "mean": pa.float64()},
+    "agb": {"fid": pa.int64(), "mean": pa.float64()},
+}
+
+# Image year and feature id of flattened image collection features
+system_index_pattern = r"^(?P<year>[0-9]{4})_.*_(?P<feature>[^_]+)$"
+
+# First coordinate pair of a GeoJSON geometry
+geo_pattern = (
+    r'"coordinates":\[+(?P<longitude>-?[0-9.eE+-]+),(?P<latitude>-?[0-9.eE+-]+)'
+)
+
+
+def gee_csv_file_name(product: str, region: str, lc: int):
+    file_name = Path(
+        config["data_dir"], "gee_results", f"{product}_{region}_{lc}_sample.csv"
+    )
+    return file_name
+
+
+def ingested_file_name(product: str, region: str, lc: int):
+    file_name = Path(
+        config["data_dir"], "gee_results", "parquet", product, f"{region}_{lc}.parquet"
+    )
+    return file_name
+
+
+def parse_system_index(table: pa.Table) -> pa.Table:
+    """Replace GEE system:index ({image id}_{feature id}) column with year
+    of the image and feature_index (string feature id) columns"""
+    parts = pc.extract_regex(
+        table["system:index"].cast(pa.string()), system_index_pattern
+    )
+    year = pc.cast(pc.struct_field(parts, "year"), pa.int16())
+    feature = pc.struct_field(parts, "feature")
+    index = table.schema.get_field_index("system:index")
+    table = table.remove_column(index)
+    table = table.append_column("year", year).append_column("feature_index", feature)
+    return table
+
+
+def parse_geo(table: pa.Table) -> pa.Table:
+    """Replace GeoJSON .geo column with longitude and latitude columns
+    of the first coordinate pair of the geometry"""
+    coords = pc.extract_regex(table[".geo"].cast(pa.string()), geo_pattern)
+    longitude = pc.cast(pc.struct_field(coords, "longitude"), pa.float64())
+    latitude = pc.cast(pc.struct_field(coords, "latitude"), pa.float64())
+    index = table.schema.get_field_index(".geo")
+    table = table.remove_column(index)
+    table = table.append_column("longitude", longitude)
+    table = table.append_column("latitude", latitude)
+    return table
+
+
+def read_gee_csv(file_name, product: str) -> pa.Table:
+    """Read GEE CSV export with the multithreaded Arrow reader using
+    the declared column types of the product"""
+    table = pv.read_csv(
+        file_name,
+        read_options=pv.ReadOptions(use_threads=True),
+        convert_options=pv.ConvertOptions(column_types=product_schemas[product]),
+    )
+    if "system:index" in table.column_names:
+        table = parse_system_index(table)
+    if ".geo" in table.column_names:
+        table = parse_geo(table)
+    return table
+
+
+def ingest_gee_csv(product: str, region: str, lc: int):
+    """
+    Convert GEE CSV export of the product for region and lc to typed
+    parquet. Files whose parquet is newer than the CSV are skipped.
+    Returns the parquet file path, raises FileNotFoundError if the
+    CSV export does not exist.
+    """
+    csv_file_name = gee_csv_file_name(product, region, lc)
+    out_file_name = ingested_file_name(product, region, lc)
+    csv_mtime = csv_file_name.stat().st_mtime
+    if out_file_name.is_file() and out_file_name.stat().st_mtime >= csv_mtime:
+        return out_file_name
+    table = read_gee_csv(csv_file_name, product)
+    out_file_name.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, out_file_name)
+    return out_file_name
+
+
+def ingest_gee_cell(product: str, region: str, lc: int):
+    """Ingest GEE CSV export of the product for region and lc, None if
+    the CSV export does not exist"""
+    try:
+        return ingest_gee_csv(product, region, lc)
+    except FileNotFoundError:
+        return None
+
+
+def ingest_gee_results(products: list = None, backend: str = None):
+    """Convert all GEE CSV exports of products (all by default) found
+    for configured regions and land covers, in parallel using the
+    executor backend (config executor by default)"""
+    if products is None:
+        products = list(product_schemas)
+    cells = [
+        (product, region, lc)
+        for product in products
+        for region, lc in region_lc_cells()
+    ]
+    map_cells(ingest_gee_cell, cells, backend)
+
+
+def read_gee_table(product: str, region: str, lc: int) -> pd.DataFrame:
+    """Read typed GEE export of the product for region and lc, ingesting
+    the CSV first if needed"""
+    file_name = ingest_gee_csv(product, region, lc)
+    return pd.read_parquet(file_name)
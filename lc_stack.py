@@ -0,0 +1,440 @@
+"""
+Multi-year CEH land cover stack. Annual land cover rasters are split in
+blocks which are stored once per distinct content, so blocks unchanged
+between years share storage. Block results (erosion, region counts and
+samples) are cached by the hashes of their input blocks, hence adding a
+year only recomputes blocks where land cover changed.
+author: tadasnik@gmail.com
+"""
+
+import json
+import hashlib
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+import spatial as sp
+from ceh_lc_proc import (
+    assign_region_codes,
+    bottom_k_sample,
+    erode_classes,
+    eroded_lc_file_path,
+    eroded_pixels,
+    rasterize_regions,
+    sampled_lc_file_path,
+)
+from configuration import config
+from executor import map_cells
+from raster_processing import raster_windows
+
+manifest_columns = ["year", "col_off", "row_off", "width", "height", "hash"]
+
+
+def land_cover_year_file_name(year: int) -> str:
+    return config["land_cover_file_pattern"].format(year=year)
+
+
+def stack_dir():
+    dir_name = Path(config["data_dir"], "land_cover_stack")
+    return dir_name
+
+
+def block_store_file_name(block_hash: str):
+    file_name = Path(stack_dir(), "blocks", f"{block_hash}.npy")
+    return file_name
+
+
+def manifest_file_name():
+    file_name = Path(stack_dir(), "manifest.parquet")
+    return file_name
+
+
+def grid_file_name():
+    file_name = Path(stack_dir(), "grid.json")
+    return file_name
+
+
+def result_file_name(kind: str, key: str, suffix: str = "parquet"):
+    file_name = Path(stack_dir(), "results", kind, f"{key}.{suffix}")
+    return file_name
+
+
+def content_hash(*parts) -> str:
+    """Return blake2b hex digest of bytes or string representations of parts"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+def read_manifest() -> pd.DataFrame:
+    """Return (year, block offsets and size, content hash) of stacked blocks"""
+    try:
+        return pd.read_parquet(manifest_file_name())
+    except FileNotFoundError:
+        return pd.DataFrame(columns=manifest_columns)
+
+
+def read_grid() -> dict:
+    """Return land cover grid (transform, width, height, block_size and the
+    reference file name the region raster is built from) of the stack"""
+    with open(grid_file_name()) as grid_file:
+        return json.load(grid_file)
+
+
+def check_grid(src, block_size: int, file_name: str) -> dict:
+    """Save grid of the first stacked raster, later rasters must match it"""
+    grid = {
+        "transform": list(src.transform)[:6],
+        "width": src.width,
+        "height": src.height,
+        "block_size": block_size,
+        "reference": file_name,
+    }
+    if not grid_file_name().is_file():
+        grid_file_name().parent.mkdir(parents=True, exist_ok=True)
+        with open(grid_file_name(), "w") as grid_file:
+            json.dump(grid, grid_file)
+        return grid
+    stack_grid = read_grid()
+    for key in ["transform", "width", "height", "block_size"]:
+        if stack_grid[key] != grid[key]:
+            raise ValueError(f"{file_name} {key} does not match the land cover stack")
+    return stack_grid
+
+
+def add_land_cover_year(year: int, block_size: int = 11000) -> pd.DataFrame:
+    """
+    Add annual land cover raster of the year to the stack. Blocks are
+    hashed and only blocks with new content are stored. Returns blocks
+    of the year with changed column (see year_blocks).
+    """
+    manifest = read_manifest()
+    if year in manifest.year.values:
+        return year_blocks(year, manifest)
+    file_name = land_cover_year_file_name(year)
+    file_path = Path(config["data_dir"], file_name)
+    rows = []
+    with rasterio.open(file_path) as src:
+        check_grid(src, block_size, file_name)
+        for window in raster_windows(file_path, block_size):
+            values = src.read(1, window=window)
+            block_hash = content_hash(values.tobytes(), values.shape)
+            store = block_store_file_name(block_hash)
+            if not store.is_file():
+                store.parent.mkdir(parents=True, exist_ok=True)
+                np.save(store, values)
+            rows.append(
+                [year, window.col_off, window.row_off, window.width, window.height]
+                + [block_hash]
+            )
+    manifest = pd.concat([manifest, pd.DataFrame(rows, columns=manifest_columns)])
+    manifest = manifest.astype({column: "int64" for column in manifest_columns[:-1]})
+    manifest = manifest.sort_values(["year", "row_off", "col_off"])
+    manifest.to_parquet(manifest_file_name(), index=False)
+    return year_blocks(year, manifest)
+
+
+def year_blocks(year: int, manifest: pd.DataFrame = None) -> pd.DataFrame:
+    """Return blocks of the year with changed column, True where the
+    block content differs from the previous year in the stack"""
+    if manifest is None:
+        manifest = read_manifest()
+    blocks = manifest[manifest.year == year].reset_index(drop=True)
+    previous = manifest[manifest.year < year]
+    if len(previous) == 0:
+        blocks["changed"] = True
+        return blocks
+    previous = previous[previous.year == previous.year.max()]
+    previous = previous.set_index(["col_off", "row_off"])["hash"]
+    previous_hash = previous.reindex(
+        pd.MultiIndex.from_frame(blocks[["col_off", "row_off"]])
+    )
+    blocks["changed"] = previous_hash.to_numpy() != blocks["hash"].to_numpy()
+    return blocks
+
+
+def read_block(block_hash: str) -> np.ndarray:
+    """Return memory mapped land cover block"""
+    return np.load(block_store_file_name(block_hash), mmap_mode="r")
+
+
+def halo_blocks(blocks: pd.DataFrame, window: Window, halo: int) -> pd.DataFrame:
+    """Return blocks intersecting window padded with halo pixels"""
+    left, top = window.col_off - halo, window.row_off - halo
+    right = window.col_off + window.width + halo
+    bottom = window.row_off + window.height + halo
+    mask = (blocks.col_off < right) & (blocks.col_off + blocks.width > left)
+    mask &= (blocks.row_off < bottom) & (blocks.row_off + blocks.height > top)
+    return blocks[mask]
+
+
+def read_stack_window(blocks: pd.DataFrame, window: Window, halo: int = 0):
+    """Read land cover of the window padded with halo pixels from the
+    blocks of one year. Pixels beyond the raster are 0"""
+    left, top = window.col_off - halo, window.row_off - halo
+    right = window.col_off + window.width + halo
+    bottom = window.row_off + window.height + halo
+    values = np.zeros((bottom - top, right - left), dtype="uint8")
+    for block in halo_blocks(blocks, window, halo).itertuples():
+        c_start = max(block.col_off, left)
+        c_end = min(block.col_off + block.width, right)
+        r_start = max(block.row_off, top)
+        r_end = min(block.row_off + block.height, bottom)
+        block_values = read_block(block.hash)
+        values[r_start - top : r_end - top, c_start - left : c_end - left] = (
+            block_values[
+                r_start - block.row_off : r_end - block.row_off,
+                c_start - block.col_off : c_end - block.col_off,
+            ]
+        )
+    return values
+
+
+def block_window(block) -> Window:
+    return Window(block.col_off, block.row_off, block.width, block.height)
+
+
+def erosion_key(blocks: pd.DataFrame, window: Window, lcs: list, window_size: int):
+    """Key of block erosion results, changes only if the block or any
+    neighbouring block within the erosion halo changed"""
+    neighbours = halo_blocks(blocks, window, window_size // 2)
+    neighbours = neighbours.sort_values(["row_off", "col_off"])
+    return content_hash("erosion", window, *neighbours.hash, sorted(lcs), window_size)
+
+
+def block_binary_erosion(
+    window: Window, blocks: pd.DataFrame, grid: dict, lcs: list, window_size: int
+) -> pd.DataFrame:
+    """Return cached or computed eroded pixels (y, x) with lc column of the
+    block at window"""
+    out_path = result_file_name(
+        "erosion", erosion_key(blocks, window, lcs, window_size)
+    )
+    if out_path.is_file():
+        return pd.read_parquet(out_path)
+    halo = window_size // 2
+    values = read_stack_window(blocks, window, halo)
+    eroded = erode_classes(values, lcs, window_size)
+    transform = window_transform(window, Affine(*grid["transform"]))
+    dfr = pd.concat(eroded_pixels(eroded, transform, lcs, halo).values())
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    dfr.to_parquet(out_path)
+    return dfr
+
+
+def stack_binary_erosion(
+    year: int, lcs: list, window_size: int, backend: str = "process"
+):
+    """
+    Binary errosion of land covers in lcs of the stacked year, saving
+    remaining pixels of each lc as ceh_binary_erosion does for the year's
+    land cover file. Only blocks whose (halo) content is not in the
+    results cache are eroded.
+    """
+    blocks = year_blocks(year)
+    grid = read_grid()
+    windows = [block_window(block) for block in blocks.itertuples()]
+    keys = [erosion_key(blocks, window, lcs, window_size) for window in windows]
+    cached = sum(result_file_name("erosion", key).is_file() for key in keys)
+    print(year, f"{len(windows) - cached} of {len(windows)} blocks to erode")
+    erode = partial(
+        block_binary_erosion, blocks=blocks, grid=grid, lcs=lcs, window_size=window_size
+    )
+    results = map_cells(erode, [(window,) for window in windows], backend)
+    done = pd.concat(results)
+    for lc in lcs:
+        done[done.lc == lc].to_parquet(
+            eroded_lc_file_path(
+                lc, window_size, config["data_dir"], land_cover_year_file_name(year)
+            )
+        )
+
+
+def region_raster(grid: dict) -> str:
+    """Return region code raster on the stack grid"""
+    return str(
+        rasterize_regions(config["data_dir"], grid["reference"], grid["block_size"])
+    )
+
+
+def block_region_lc_counts(
+    window: Window, blocks: pd.DataFrame, region_file_name: str, n_regions: int
+) -> np.ndarray:
+    """Return cached or computed region_code * 22 + lc_code counts of the
+    block at window"""
+    block_hash = halo_blocks(blocks, window, 0).hash.iloc[0]
+    key = content_hash(
+        "counts", block_hash, window, region_file_name, n_regions, "valid_lc"
+    )
+    out_path = result_file_name("counts", key, "npy")
+    if out_path.is_file():
+        return np.load(out_path)
+    lc_codes = read_stack_window(blocks, window)
+    with rasterio.open(region_file_name) as src:
+        region_codes = src.read(1, window=window)
+    # codes above 21 (e.g. nodata 255) would spill into other regions
+    valid = lc_codes <= 21
+    counts = np.bincount(
+        region_codes[valid].astype(np.int64) * 22 + lc_codes[valid],
+        minlength=(n_regions + 1) * 22,
+    )
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(out_path, counts)
+    return counts
+
+
+def stack_region_value_counts(year: int, backend: str = None) -> pd.DataFrame:
+    """Land cover (index) value counts per HadUKP region (columns) of the
+    stacked year, as ceh_region_value_counts. Counts of unchanged blocks
+    are taken from the results cache"""
+    regions = gpd.read_file(config["regions_file"]).Region.values
+    blocks = year_blocks(year)
+    count = partial(
+        block_region_lc_counts,
+        blocks=blocks,
+        region_file_name=region_raster(read_grid()),
+        n_regions=len(regions),
+    )
+    windows = [(block_window(block),) for block in blocks.itertuples()]
+    counts = sum(map_cells(count, windows, backend))
+    counts = counts.reshape(len(regions) + 1, 22)
+    dfr = pd.DataFrame(counts[1:, 1:].T, index=range(1, 22, 1), columns=regions)
+    return dfr
+
+
+def block_eroded_sample(
+    window: Window,
+    blocks: pd.DataFrame,
+    grid: dict,
+    region_file_name: str,
+    lcs: list,
+    window_size: int,
+    sample_size: int,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Return cached or computed sample of up to sample_size eroded pixels
+    per region and lc of the block at window, see window_eroded_sample"""
+    key = content_hash(
+        "sample", erosion_key(blocks, window, lcs, window_size), sample_size, seed
+    )
+    out_path = result_file_name("samples", key)
+    if out_path.is_file():
+        return pd.read_parquet(out_path)
+    dfr = block_binary_erosion(window, blocks, grid, lcs, window_size).reset_index()
+    transform = Affine(*grid["transform"])
+    rows = np.floor((dfr.y.to_numpy() - transform.f) / transform.e).astype(np.int64)
+    cols = np.floor((dfr.x.to_numpy() - transform.c) / transform.a).astype(np.int64)
+    with rasterio.open(region_file_name) as src:
+        region_codes = src.read(1, window=window)
+    dfr["region_code"] = region_codes[rows - window.row_off, cols - window.col_off]
+    dfr = dfr[dfr.region_code > 0]
+    rng = np.random.default_rng([seed, window.col_off, window.row_off])
+    dfr["key"] = rng.random(len(dfr))
+    dfr = bottom_k_sample(dfr, ["region_code", "lc"], sample_size)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    dfr.to_parquet(out_path)
+    return dfr
+
+
+def stack_sample_eroded(
+    year: int,
+    lcs: list,
+    window_size: int,
+    sample_size: int,
+    seed: int = 0,
+    backend: str = "process",
+):
+    """
+    Sample sample_size eroded pixels per region for every land cover in
+    lcs of the stacked year, saving samples as ceh_sample_eroded does for
+    the year's land cover file. Block samples of unchanged blocks are
+    taken from the results cache.
+    """
+    blocks = year_blocks(year)
+    grid = read_grid()
+    sample = partial(
+        block_eroded_sample,
+        blocks=blocks,
+        grid=grid,
+        region_file_name=region_raster(grid),
+        lcs=lcs,
+        window_size=window_size,
+        sample_size=sample_size,
+        seed=seed,
+    )
+    windows = [(block_window(block),) for block in blocks.itertuples()]
+    results = map_cells(sample, windows, backend)
+    samples = bottom_k_sample(pd.concat(results), ["region_code", "lc"], sample_size)
+    samples = samples.drop("key", axis=1)
+    for lc in lcs:
+        dfr = samples[samples.lc == lc].set_index(["y", "x"])
+        dfr = assign_region_codes(sp.osgb_to_lonlat(dfr))
+        dfr.to_parquet(
+            sampled_lc_file_path(
+                lc, window_size, config["data_dir"], land_cover_year_file_name(year)
+            )
+        )
+
+
+def fire_land_cover(fire: pd.DataFrame) -> np.ndarray:
+    """
+    Return land cover of fire detections (longitude, latitude and year
+    columns) in the stacked land cover of their own year, or of the
+    latest earlier stacked year (earliest stacked year for fires before
+    it). Detections outside the land cover grid get 0.
+    """
+    manifest = read_manifest()
+    grid = read_grid()
+    transform = Affine(*grid["transform"])
+    years = np.sort(manifest.year.unique())
+    nr = np.searchsorted(years, fire["year"].to_numpy(), side="right") - 1
+    fire_years = years[np.maximum(nr, 0)]
+    x, y = sp.transform_coordinates(
+        fire["longitude"], fire["latitude"], "EPSG:4326", "EPSG:27700"
+    )
+    rows = np.floor((y - transform.f) / transform.e).astype(np.int64)
+    cols = np.floor((x - transform.c) / transform.a).astype(np.int64)
+    inside = (rows >= 0) & (rows < grid["height"]) & (cols >= 0)
+    inside &= cols < grid["width"]
+    block_rows = rows // grid["block_size"] * grid["block_size"]
+    block_cols = cols // grid["block_size"] * grid["block_size"]
+    lc = np.zeros(len(fire), dtype="uint8")
+    blocks = manifest.set_index(["year", "row_off", "col_off"])["hash"]
+    points = pd.DataFrame(
+        {"year": fire_years, "row_off": block_rows, "col_off": block_cols}
+    )[inside]
+    for (year, row_off, col_off), index in points.groupby(
+        ["year", "row_off", "col_off"]
+    ).indices.items():
+        positions = np.flatnonzero(inside)[index]
+        values = read_block(blocks.loc[(year, row_off, col_off)])
+        lc[positions] = values[rows[positions] - row_off, cols[positions] - col_off]
+    return lc
+
+
+if __name__ == "__main__":
+    pass
+    # Add annual land cover maps to the stack, then erode, count and
+    # sample each year. Only blocks changed since the previous year are
+    # recomputed.
+    """
+    for year in config['land_cover_years']:
+        blocks = add_land_cover_year(year)
+        print(year, blocks.changed.sum(), 'changed blocks')
+        stack_binary_erosion(year, config['land_covers'], config['window_size'])
+        dfr = stack_region_value_counts(year)
+        dfr.to_parquet(Path(config["data_dir"], f"lc_counts_per_region_{year}.parquet"))
+        stack_sample_eroded(year,
+                            config['land_covers'],
+                            config['window_size'],
+                            config['sample_size'])
+    """
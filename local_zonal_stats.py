@@ -0,0 +1,282 @@
+"""
+Zonal statistics of sample points over local rasters, a local stand in
+for gee_data.zonal_stats writing the same CSV as the GEE exports
+author: tadasnik@gmail.com
+"""
+
+import re
+import uuid
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+
+from configuration import config
+from export_jobs import job_samples
+from gee_features import EARTH_RADIUS
+from ingest import phenology_columns
+from spatial import transform_coordinates
+
+# Bands, reducer and scale (m) of products as exported by gee_data. Named
+# bands are matched to raster band descriptions, single unnamed bands are
+# output under the reducer name as Earth Engine does
+product_reductions = {
+    "VNP13A1": {
+        "bands": ["EVI2", "NDVI", "pixel_reliability", "composite_day_of_the_year"],
+        "reducer": "first",
+        "scale": 500,
+    },
+    "VNP22Q2": {"bands": phenology_columns, "reducer": "first", "scale": 500},
+    "agb": {"bands": [1], "reducer": "mean", "scale": 20},
+    "height": {"bands": [1], "reducer": "mean", "scale": 20},
+}
+
+# Image date in file names, YYYY-MM-DD, YYYYMMDD or MODIS/VIIRS AYYYYDDD
+date_pattern = re.compile(
+    r"(?P<date>[0-9]{4}-?[0-9]{2}-?[0-9]{2})|\.A(?P<doy>[0-9]{7})\."
+)
+
+
+def image_date(file_name):
+    """Return date of the image parsed from the file name, None if the
+    name has no date"""
+    match = date_pattern.search(Path(file_name).name)
+    if match is None:
+        return None
+    if match.group("doy"):
+        return pd.to_datetime(match.group("doy"), format="%Y%j")
+    return pd.to_datetime(match.group("date").replace("-", ""), format="%Y%m%d")
+
+
+def product_images(product: str, start_date=None, end_date=None) -> list:
+    """
+    Return (date, file_name) of local rasters of the product (glob pattern
+    in config local_rasters relative to data_dir) sorted by date. Dated
+    images are restricted to start_date <= date < end_date. Raises
+    FileNotFoundError if there are no images.
+    """
+    pattern = config.get("local_rasters", {}).get(product)
+    if pattern is None:
+        raise FileNotFoundError(f"no local_rasters pattern of {product}")
+    images = [
+        (image_date(file_name), file_name)
+        for file_name in sorted(Path(config["data_dir"]).glob(pattern))
+    ]
+    if start_date is not None:
+        images = [x for x in images if x[0] is None or x[0] >= pd.Timestamp(start_date)]
+    if end_date is not None:
+        images = [x for x in images if x[0] is None or x[0] < pd.Timestamp(end_date)]
+    if len(images) == 0:
+        raise FileNotFoundError(f"no local rasters of {product} matching {pattern}")
+    return sorted(images, key=lambda x: (x[0] is not None, x[0] or 0))
+
+
+def footprint_samples(longitude, latitude, half_size: float, step: float):
+    """
+    Return longitude, latitude (n_points, n_samples) of sample points on a
+    step m grid covering the half_size m square footprints of the points
+    (see gee_features.point_footprints). Footprints smaller than step are
+    sampled at the point only.
+    """
+    longitude = np.asarray(longitude, dtype=float)[:, None]
+    latitude = np.asarray(latitude, dtype=float)[:, None]
+    n_steps = max(int(round(2 * half_size / step)), 1)
+    offsets = (np.arange(n_steps) + 0.5) * (2 * half_size / n_steps) - half_size
+    dx, dy = [x.ravel()[None, :] for x in np.meshgrid(offsets, offsets)]
+    lat = latitude + np.degrees(dy / EARTH_RADIUS)
+    lon = longitude + np.degrees(dx / (EARTH_RADIUS * np.cos(np.radians(latitude))))
+    return lon, lat
+
+
+def pixel_indices(transform, x, y) -> tuple:
+    """Return int64 rows, cols of pixels containing x, y from the inverse
+    geotransform"""
+    cols, rows = ~transform * (np.asarray(x), np.asarray(y))
+    return np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+
+
+def read_samples(srcs: list, bands: list, rows, cols, block_size: int = 1024):
+    """
+    Return float values (images, bands, samples) of the pixels at rows,
+    cols of open rasters sharing a grid, NaN beyond the raster or where
+    nodata. Samples are grouped in block_size blocks and only the extent
+    of the samples in each block is read, for all images at once.
+    """
+    src = srcs[0]
+    values = np.full((len(srcs), len(bands), len(rows)), np.nan)
+    inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+    index = np.flatnonzero(inside)
+    blocks = (rows[index] // block_size) * (src.width // block_size + 1)
+    blocks += cols[index] // block_size
+    order = np.argsort(blocks, kind="stable")
+    index, blocks = index[order], blocks[order]
+    starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(index)]):
+        block_index = index[start:end]
+        block_rows, block_cols = rows[block_index], cols[block_index]
+        row_off, col_off = block_rows.min(), block_cols.min()
+        window = Window(
+            col_off,
+            row_off,
+            block_cols.max() + 1 - col_off,
+            block_rows.max() + 1 - row_off,
+        )
+        stack = np.stack([x.read(bands, window=window) for x in srcs])
+        values[:, :, block_index] = stack[
+            :, :, block_rows - row_off, block_cols - col_off
+        ]
+    for nr, image_src in enumerate(srcs):
+        for band_nr, band in enumerate(bands):
+            nodata = image_src.nodatavals[band - 1]
+            if nodata is not None:
+                values[nr, band_nr][values[nr, band_nr] == nodata] = np.nan
+    return values
+
+
+def reduce_samples(values, n_points: int, reducer: str = "first"):
+    """Reduce values (images, bands, n_points * n_samples) to (images,
+    bands, n_points) over the samples of each point, ignoring NaN"""
+    values = values.reshape(values.shape[:2] + (n_points, -1))
+    valid = ~np.isnan(values)
+    if reducer == "mean":
+        counts = valid.sum(axis=-1)
+        sums = np.where(valid, values, 0).sum(axis=-1)
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    if reducer == "first":
+        first = valid.argmax(axis=-1)[..., None]
+        return np.take_along_axis(values, first, axis=-1)[..., 0]
+    raise ValueError(f"unknown reducer {reducer}")
+
+
+def grid_key(src) -> tuple:
+    return (src.crs.to_string(), tuple(src.transform), src.width, src.height)
+
+
+def local_zonal_stats(
+    images: list,
+    dfr: pd.DataFrame,
+    bands: list = None,
+    reducer: str = "first",
+    scale: float = None,
+    half_size: float = 20.0,
+    block_size: int = 1024,
+) -> pd.DataFrame:
+    """
+    Reduce local rasters over half_size m square footprints of points in
+    dfr (longitude, latitude columns), the local equivalent of
+    gee_data.zonal_stats. images are (date or None, file_name) pairs,
+    bands are band numbers or descriptions (all bands by default).
+    Footprints are sampled on a grid of scale m (native pixel size by
+    default). The mean reducer is unweighted over the samples, first
+    takes the first valid sample. Images sharing a grid are read and
+    reduced together. Returns rows of the GEE CSV export: date, timestamp
+    (dated images only), fid (dfr index) and a column per band, without
+    rows with missing values.
+    """
+    results = []
+    with ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(x[1])) for x in images]
+        src = srcs[0]
+        if bands is None:
+            bands = list(src.indexes)
+        names = [x for x in bands if isinstance(x, str)]
+        indexes = [src.descriptions.index(x) + 1 if x in names else x for x in bands]
+        if len(names) == 0:
+            names = [reducer] if len(bands) == 1 else [f"b{x}" for x in indexes]
+        grids = {}
+        for image, image_src in zip(images, srcs):
+            grids.setdefault(grid_key(image_src), []).append((image[0], image_src))
+        for grid_images in grids.values():
+            grid_src = grid_images[0][1]
+            step = scale
+            if step is None:
+                step = grid_src.res[0]
+                if grid_src.crs.is_geographic:
+                    step = np.radians(step) * EARTH_RADIUS
+            lon, lat = footprint_samples(dfr.longitude, dfr.latitude, half_size, step)
+            x, y = transform_coordinates(
+                lon.ravel(), lat.ravel(), "EPSG:4326", grid_src.crs.to_string()
+            )
+            rows, cols = pixel_indices(grid_src.transform, x, y)
+            values = read_samples(
+                [image[1] for image in grid_images], indexes, rows, cols, block_size
+            )
+            values = reduce_samples(values, len(dfr), reducer)
+            for (date, _), image_values in zip(grid_images, values):
+                res = pd.DataFrame(dict(zip(names, image_values)))
+                res.insert(0, "fid", dfr.index.to_numpy())
+                if date is not None:
+                    res.insert(0, "timestamp", date.value // 1_000_000)
+                    res.insert(0, "date", date)
+                results.append(res)
+        dtypes = [np.dtype(src.dtypes[x - 1]) for x in indexes]
+    results = pd.concat(results, ignore_index=True).dropna(subset=names)
+    if reducer == "first":
+        # first keeps the band type, as in the Earth Engine output
+        for name, dtype in zip(names, dtypes):
+            results[name] = results[name].astype(dtype)
+    if "date" in results.columns:
+        results = results.sort_values(["date", "fid"], kind="stable")
+    return results.reset_index(drop=True)
+
+
+def product_zonal_stats(
+    product: str, dfr: pd.DataFrame, start_date=None, end_date=None
+):
+    """Return local zonal stats of the product local rasters as exported
+    by gee_data"""
+    images = product_images(product, start_date, end_date)
+    return local_zonal_stats(images, dfr, **product_reductions[product])
+
+
+def write_gee_csv(results: pd.DataFrame, file_name):
+    """Write zonal stats as the CSV of a GEE export"""
+    Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+    results.to_csv(file_name, index=False, date_format="%Y-%m-%d")
+
+
+class LocalRasterBackend(object):
+    """
+    Run export jobs (see export_jobs.run_jobs) as local zonal stats of
+    the product local rasters, writing the CSV the Earth Engine export
+    would to out_dir. Tasks complete on submission, jobs of products
+    without local rasters fail, other errors are raised.
+    """
+
+    def __init__(self, out_dir=None):
+        self.out_dir = (
+            Path(config["data_dir"], "gee_results") if out_dir is None else out_dir
+        )
+        self.tasks = {}
+
+    def submit(self, job: dict) -> str:
+        task_id = f"local_{uuid.uuid4().hex}"
+        dfr = job_samples(job)
+        try:
+            results = product_zonal_stats(
+                job["product"], dfr, job.get("start_date"), job.get("end_date")
+            )
+        except FileNotFoundError as error:
+            self.tasks[task_id] = ("FAILED", str(error))
+            return task_id
+        write_gee_csv(results, Path(self.out_dir, f"{job['name']}.csv"))
+        self.tasks[task_id] = ("COMPLETED", None)
+        return task_id
+
+    def status(self, task_id: str) -> tuple:
+        return self.tasks.get(task_id, ("COMPLETED", None))
+
+
+if __name__ == "__main__":
+    pass
+    """
+    from export_jobs import extraction_jobs, run_jobs
+    from ingest import ingest_gee_results
+
+    jobs = extraction_jobs(["agb", "height"])
+    ledger = run_jobs(jobs, LocalRasterBackend(), poll_interval=0)
+    ingest_gee_results(["agb", "height"])
+    """
@@ -1,15 +1,18 @@
+from functools import partial
 from pathlib import Path
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy.stats import theilslopes
 from configuration import config
+from executor import map_cells, region_lc_cells
 
 from prepare_data import (
     fwi_quantiles_monthly_file_name,
     fire_phenology_file_name,
     fwi_file_name,
     fwi_phen_phase_file,
+    fwi_phen_phase_lc,
     phenology_quantiles_file,
     evi2_phen_phase_file,
 )
@@ -58,76 +61,66 @@ def ndvi_change_vs_fwi(region, lc, fwis):
     plt.show()
 
 
-fwi = pd.read_parquet(fwi_phen_phase_file())
-
-results = []
-for region in config["regions"]:
-    for lc in config["land_covers"]:
-        print(region, lc)
-        fwis = fwi[fwi.Region == region]
-        # ndvi_change_vs_fwi(region, lc, fwis)
-        try:
-            dfr = pd.read_parquet(
-                f"/Users/tadas/modFire/fire_lc_ndvi/data/cehlc/gee_results/VNP13A1_{region}_{lc}_sample.parquet"
-            )
-        except FileNotFoundError:
-            continue
-        dfr = dfr[dfr.pixel_reliability < 5]
-        dfr = dfr.drop_duplicates(["fid", "composite_day_of_the_year"])
-
-        dfr["year"] = pd.to_datetime(dfr.date).dt.year
-        dfr["month"] = pd.to_datetime(dfr.date).dt.month
-        dfr["doy"] = pd.to_datetime(dfr.date).dt.dayofyear
-        dfr["obs_date"] = pd.to_datetime(
-            dfr["year"] * 1000 + dfr["composite_day_of_the_year"], format="%Y%j"
-        )
-        dfr["ndvi_med"] = dfr.groupby("fid")["NDVI"].transform(
-            lambda s: s.rolling(2, min_periods=1).median()
-        )
-        dfr["change"] = dfr.groupby("fid")["ndvi_med"].transform(pd.Series.diff)
-        """
-        dfr["slope"] = 0.0
-        dfr["min_slope"] = 0.0
-        dfr["max_slope"] = 0.0
-        dates = dfr.date.unique()
-        slopes = []
-        for nr, date in enumerate(dates[1:-2], 1):
-            print(nr, date)
-            dfrs = dfr[dfr.date.isin([dates[nr - 1], date])]
-            result = theilslopes(dfrs.NDVI, dfrs.composite_day_of_the_year)
-            print(result.slope)
-            slopes.append(result.slope)
-            dfr.loc[dfr.date == date, "slope"] = result.slope
-            dfr.loc[dfr.date == date, "min_slope"] = result.low_slope
-            dfr.loc[dfr.date == date, "max_slope"] = result.high_slope
-        """
-        fwisg = (
-            fwis.groupby(["year", "woy"])[["dufmcode", "fwinx", "drtcode", "ffmcode"]]
-            .median()
-            .reset_index()
-        )
-        fwisg["season"] = (
-            fwis.groupby(["year", "woy"])["season"]
-            .agg(lambda x: pd.Series.mode(x)[0])
-            .values
-        )
-        fwisg["month"] = (
-            fwis.groupby(["year", "woy"])["month"]
-            .agg(lambda x: pd.Series.mode(x)[0])
-            .values
+def ndvi_fwi_weekly(region, lc, fwi):
+    """Return weekly median NDVI change of region and lc samples with
+    weekly FWI medians and phenology phase, None if samples are missing"""
+    fwis = fwi_phen_phase_lc(fwi[fwi.Region == region], lc)
+    # ndvi_change_vs_fwi(region, lc, fwis)
+    try:
+        dfr = pd.read_parquet(
+            f"/Users/tadas/modFire/fire_lc_ndvi/data/cehlc/gee_results/VNP13A1_{region}_{lc}_sample.parquet"
         )
+    except FileNotFoundError:
+        return None
+    dfr = dfr[dfr.pixel_reliability < 5]
+    dfr = dfr.drop_duplicates(["fid", "composite_day_of_the_year"])
 
-        dfrg = (
-            # dfr.groupby(["year", "woy"])[["change", "slope", "min_slope", "max_slope", "NDVI"]]
-            dfr.groupby(["year", "woy"])[["change", "NDVI"]]
-            .quantile(0.5)
-            .reset_index()
-        )
-        dfrg = pd.merge(dfrg, fwisg, on=["year", "woy"], how="left")
-        dfrg = dfrg.dropna()
-        dfrg["Region"] = region
-        dfrg["lc"] = lc
-        results.append(dfrg)
+    dfr["year"] = pd.to_datetime(dfr.date).dt.year
+    dfr["month"] = pd.to_datetime(dfr.date).dt.month
+    dfr["doy"] = pd.to_datetime(dfr.date).dt.dayofyear
+    dfr["obs_date"] = pd.to_datetime(
+        dfr["year"] * 1000 + dfr["composite_day_of_the_year"], format="%Y%j"
+    )
+    dfr["ndvi_med"] = dfr.groupby("fid")["NDVI"].transform(
+        lambda s: s.rolling(2, min_periods=1).median()
+    )
+    dfr["change"] = dfr.groupby("fid")["ndvi_med"].transform(pd.Series.diff)
+    fwisg = (
+        fwis.groupby(["year", "woy"])[["dufmcode", "fwinx", "drtcode", "ffmcode"]]
+        .median()
+        .reset_index()
+    )
+    fwisg["season"] = (
+        fwis.groupby(["year", "woy"])["season"]
+        .agg(lambda x: pd.Series.mode(x)[0])
+        .values
+    )
+    fwisg["month"] = (
+        fwis.groupby(["year", "woy"])["month"]
+        .agg(lambda x: pd.Series.mode(x)[0])
+        .values
+    )
+
+    dfrg = (
+        # dfr.groupby(["year", "woy"])[["change", "slope", "min_slope", "max_slope", "NDVI"]]
+        dfr.groupby(["year", "woy"])[["change", "NDVI"]]
+        .quantile(0.5)
+        .reset_index()
+    )
+    dfrg = pd.merge(dfrg, fwisg, on=["year", "woy"], how="left")
+    dfrg = dfrg.dropna()
+    dfrg["Region"] = region
+    dfrg["lc"] = lc
+    return dfrg
+
+
+fwi = pd.read_parquet(fwi_phen_phase_file())
+
+# Threads share the FWI table, the script is not safe to re-import in processes
+results = map_cells(
+    partial(ndvi_fwi_weekly, fwi=fwi), region_lc_cells(region_first=True), "thread"
+)
+results = [x for x in results if x is not None]
 dfr = pd.concat(results)
 
 
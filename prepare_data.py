@@ -1,7 +1,20 @@
+import numpy as np
 import pandas as pd
 import spatial as sp
+from functools import partial
 from pathlib import Path
 from configuration import config
+from executor import iter_cells, map_cells, region_lc_cells
+from ingest import product_schemas, read_gee_csv, read_gee_table
+from quantiles import (
+    grouped_quantiles,
+    histogram_quantiles,
+    integer_histograms,
+    merge_sketches,
+    quantile_sketch,
+    sketch_quantiles,
+    stream_quantile_sketch,
+)
 
 
 # 5th Percentile
@@ -104,47 +117,137 @@ def fwi_phen_phase_file():
     return file_name
 
 
-def fwi_doy_quantiles():
+def fwi_sketch_dir():
+    dir_name = Path(config["data_dir"], "results", "fwi_sketches")
+    return dir_name
+
+
+def fwi_sketch_file_name(kind: str, year: int):
+    """Return path of yearly FWI quantile sketch, kind is doy or monthly"""
+    file_name = Path(fwi_sketch_dir(), f"UK_fwi_{kind}_sketch_{year}.parquet")
+    return file_name
+
+
+fwi_columns = ["fbupinx", "infsinx", "fwinx", "dufmcode", "ffmcode", "drtcode"]
+
+fwi_sketch_groups = {"doy": ["Region", "doy"], "monthly": ["Region", "year", "month"]}
+
+fwi_sketch_quantiles = {
+    "doy": [0.05, 0.25, 0.5, 0.75, 0.95, 0.99],
+    "monthly": [0.05, 0.25, 0.5, 0.75, 0.95],
+}
+
+
+def fwi_doy_quantiles(sketch: bool = False):
+    """Calculate FWI index quantiles per Region and day of year. With
+    sketch=True the FWI table is streamed into quantile sketches instead of
+    being loaded, giving quantiles within quantiles.SKETCH_ALPHA relative error"""
     file_name = fwi_file_name()
-    fwi = pd.read_parquet(file_name)
-    subg = fwi.groupby(["Region", "doy"])
-    subg = subg.agg(
-        {
-            "fbupinx": [q5, q25, q50, q75, q95, q99],
-            "infsinx": [q5, q25, q50, q75, q95, q99],
-            "fwinx": [q5, q25, q50, q75, q95, q99],
-            "dufmcode": [q5, q25, q50, q75, q95, q99],
-            "ffmcode": [q5, q25, q50, q75, q95, q99],
-            "drtcode": [q5, q25, q50, q75, q95, q99],
-        }
-    )
+    by = fwi_sketch_groups["doy"]
+    quantiles = fwi_sketch_quantiles["doy"]
+    if sketch:
+        fwi_sketch = stream_quantile_sketch(file_name, by, fwi_columns)
+        subg = sketch_quantiles(fwi_sketch, quantiles)[fwi_columns]
+    else:
+        fwi = pd.read_parquet(file_name)
+        subg = grouped_quantiles(fwi, by, fwi_columns, quantiles)
     out_file_name = fwi_quantiles_file_name()
     subg.to_parquet(out_file_name)
 
 
-def fwi_monthly_quantiles():
+def fwi_monthly_quantiles(sketch: bool = False):
+    """Calculate FWI index quantiles per Region, year and month, optionally
+    from streamed quantile sketches (see fwi_doy_quantiles)"""
     file_name = fwi_file_name()
-    fwi = pd.read_parquet(file_name)
-    subg = fwi.groupby(["Region", "year", "month"])
-    subg = subg.agg(
-        {
-            "fbupinx": [q5, q25, q50, q75, q95],
-            "infsinx": [q5, q25, q50, q75, q95],
-            "fwinx": [q5, q25, q50, q75, q95],
-            "dufmcode": [q5, q25, q50, q75, q95],
-            "ffmcode": [q5, q25, q50, q75, q95],
-            "drtcode": [q5, q25, q50, q75, q95],
-        }
-    )
+    by = fwi_sketch_groups["monthly"]
+    quantiles = fwi_sketch_quantiles["monthly"]
+    if sketch:
+        fwi_sketch = stream_quantile_sketch(file_name, by, fwi_columns)
+        subg = sketch_quantiles(fwi_sketch, quantiles)[fwi_columns]
+    else:
+        fwi = pd.read_parquet(file_name)
+        subg = grouped_quantiles(fwi, by, fwi_columns, quantiles)
     out_file_name = fwi_quantiles_monthly_file_name()
     subg.to_parquet(out_file_name)
 
 
+def fwi_year_sketches(fwi: pd.DataFrame):
+    """Write doy and monthly quantile sketches of FWI indices for
+    each year found in fwi"""
+    for year, fwi_year in fwi.groupby("year"):
+        for kind, by in fwi_sketch_groups.items():
+            file_name = fwi_sketch_file_name(kind, year)
+            file_name.parent.mkdir(parents=True, exist_ok=True)
+            fwi_sketch = quantile_sketch(fwi_year, by, fwi_columns)
+            fwi_sketch.to_parquet(file_name)
+
+
+def fwi_quantiles_from_sketches():
+    """Refresh FWI quantile files by merging the stored yearly sketches"""
+    out_file_names = {
+        "doy": fwi_quantiles_file_name(),
+        "monthly": fwi_quantiles_monthly_file_name(),
+    }
+    for kind, out_file_name in out_file_names.items():
+        file_names = sorted(fwi_sketch_dir().glob(f"UK_fwi_{kind}_sketch_*.parquet"))
+        fwi_sketch = merge_sketches([pd.read_parquet(x) for x in file_names])
+        subg = sketch_quantiles(fwi_sketch, fwi_sketch_quantiles[kind])
+        subg[fwi_columns].to_parquet(out_file_name)
+
+
+def replace_years_in_parquet(file_name: Path, dfr: pd.DataFrame):
+    """
+    Replace rows of the years present in dfr in parquet file_name with dfr.
+    Rows of other years are copied batch by batch, so the existing table
+    is never loaded in full.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(dfr, preserve_index=False)
+    if not Path(file_name).is_file():
+        pq.write_table(table, file_name)
+        return
+    parquet_file = pq.ParquetFile(file_name)
+    columns = [x for x in parquet_file.schema_arrow.names if x in dfr.columns]
+    schema = parquet_file.schema_arrow.remove_metadata()
+    schema = pa.schema([schema.field(x) for x in columns])
+    years = pa.array(dfr["year"].unique(), type=schema.field("year").type)
+    tmp_file_name = Path(file_name).with_suffix(".tmp")
+    with pq.ParquetWriter(tmp_file_name, schema) as writer:
+        for batch in parquet_file.iter_batches(columns=columns):
+            batch = pa.Table.from_batches([batch]).cast(schema)
+            writer.write_table(batch.filter(pc.invert(pc.is_in(batch["year"], years))))
+        writer.write_table(table.select(columns).cast(schema))
+    tmp_file_name.replace(file_name)
+
+
+def update_fwi_year(file_path: str, regions_file_path: str):
+    """
+    Add a new season (or seasons) of CEMS FWI indices in file_path to
+    the FWI table, yearly sketches, quantile files and phenology phase
+    table, processing only the new data.
+    """
+    fwi = prepare_fwi(file_path, regions_file_path)
+    replace_years_in_parquet(fwi_file_name(), fwi)
+    fwi_year_sketches(fwi)
+    fwi_quantiles_from_sketches()
+    replace_years_in_parquet(fwi_phen_phase_file(), fwi_phenology_phases(fwi))
+
+
 def fire_phenology_file_name():
     file_name = Path(config["data_dir"], "results", "UK_fire_phenology_dates.parquet")
     return file_name
 
 
+def fire_event_dates_file_name():
+    file_name = Path(
+        config["data_dir"], "results", "UK_fire_event_phenology_dates.parquet"
+    )
+    return file_name
+
+
 def phenology_doy(dfr):
     """Convert VNP22Q2 product date columns to standard dates"""
     date_cols = [
@@ -155,117 +258,147 @@ def phenology_doy(dfr):
     return dfr
 
 
-def combine_phenology():
-    dfrs = []
-    for lc in config["land_covers"]:
-        for region in config["regions"]:
-            file_name = Path(
-                config["data_dir"], "gee_results", f"VNP22Q2_{region}_{lc}_sample.csv"
-            )
-            try:
-                df = pd.read_csv(file_name)
-            except FileNotFoundError:
-                continue
-            df["date"] = pd.to_datetime(df.date)
-            df["year"] = df.date.dt.year
-            df["Region"] = region
-            df["lc"] = lc
-            df = phenology_doy(df)
-            dfrs.append(df)
-    phe = pd.concat(dfrs)
+def combine_phenology(backend: str = None):
+    """Combine VNP22Q2 exports of all regions and land covers into the
+    phenology file, writing one export at a time"""
     phe_file_name = phenology_file()
-    phe.to_parquet(phe_file_name)
-    return phe
+    dfrs = iter_cells(phenology_export, region_lc_cells(), backend)
+    write_parquet_stream(
+        (x for x in dfrs if x is not None),
+        phe_file_name,
+        product_schemas["VNP22Q2"],
+    )
+    return phe_file_name
 
 
-def combine_dem():
-    dfrs = []
-    for lc in config["land_covers"]:
-        for region in config["regions"]:
-            file_name = Path(
-                config["data_dir"], "gee_results", f"MERIT_DEM_{region}_{lc}_sample.csv"
-            )
-            try:
-                df = pd.read_csv(file_name)
-            except FileNotFoundError:
-                continue
-            df["Region"] = region
-            df["lc"] = lc
-            df = df.drop(["date"], axis=1)
-            dfrs.append(df)
-    dem = pd.concat(dfrs)
+def phenology_export(region: str, lc: int):
+    """Return prepared VNP22Q2 export of region and lc, None if missing"""
+    try:
+        df = read_gee_table("VNP22Q2", region, lc)
+    except FileNotFoundError:
+        return None
+    df["year"] = df.date.dt.year
+    df["Region"] = region
+    df["lc"] = lc
+    df = phenology_doy(df)
+    return df
+
+
+def combine_dem(backend: str = None):
+    """Combine MERIT DEM exports of all regions and land covers into the
+    dem file, writing one export at a time"""
     dem_file_name = dem_file()
-    dem.to_parquet(dem_file_name)
-    return dem
+    dfrs = iter_cells(dem_export, region_lc_cells(), backend)
+    write_parquet_stream(
+        (x for x in dfrs if x is not None),
+        dem_file_name,
+        product_schemas["MERIT_DEM"],
+    )
+    return dem_file_name
+
+
+def dem_export(region: str, lc: int):
+    """Return prepared MERIT DEM export of region and lc, None if missing"""
+    try:
+        df = read_gee_table("MERIT_DEM", region, lc)
+    except FileNotFoundError:
+        return None
+    df["Region"] = region
+    df["lc"] = lc
+    df = df.drop(["date"], axis=1)
+    return df
+
+
+def write_parquet_stream(dfrs, file_name, types: dict = None):
+    """Write data frames in dfrs to parquet file_name one at a time,
+    without concatenating them in memory. Columns declared in types
+    (e.g. ingest.product_schemas) are written with the declared type,
+    the others with their type in the first data frame"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {} if types is None else types
+    writer = None
+    for dfr in dfrs:
+        table = pa.Table.from_pandas(dfr, preserve_index=False)
+        if writer is None:
+            schema = pa.schema(
+                [
+                    pa.field(field.name, types.get(field.name, field.type))
+                    for field in table.schema
+                ]
+            )
+            writer = pq.ParquetWriter(file_name, schema)
+        writer.write_table(table.cast(writer.schema))
+    if writer is not None:
+        writer.close()
 
 
 def phenology_quantiles():
     phe_file_name = phenology_file()
     phe = pd.read_parquet(phe_file_name)
-    pheg = phe.groupby(["Region", "lc"])
-    pheg = pheg.agg(
-        {
-            "Onset_Greenness_Increase_1": [q5, q25, q50, q75, q95],
-            "Onset_Greenness_Maximum_1": [q5, q25, q50, q75, q95],
-            "Onset_Greenness_Decrease_1": [q5, q25, q50, q75, q95],
-            "Onset_Greenness_Minimum_1": [q5, q25, q50, q75, q95],
-            "Date_Mid_Greenup_Phase_1": [q5, q25, q50, q75, q95],
-            "Date_Mid_Senescence_Phase_1": [q5, q25, q50, q75, q95],
-            "EVI2_Growing_Season_Area_1": [q5, q25, q50, q75, q95],
-            "Growing_Season_Length_1": [q5, q25, q50, q75, q95],
-            "EVI2_Onset_Greenness_Increase_1": [q5, q25, q50, q75, q95],
-            "EVI2_Onset_Greenness_Maximum_1": [q5, q25, q50, q75, q95],
-        }
+    pheg = grouped_quantiles(
+        phe,
+        ["Region", "lc"],
+        [
+            "Onset_Greenness_Increase_1",
+            "Onset_Greenness_Maximum_1",
+            "Onset_Greenness_Decrease_1",
+            "Onset_Greenness_Minimum_1",
+            "Date_Mid_Greenup_Phase_1",
+            "Date_Mid_Senescence_Phase_1",
+            "EVI2_Growing_Season_Area_1",
+            "Growing_Season_Length_1",
+            "EVI2_Onset_Greenness_Increase_1",
+            "EVI2_Onset_Greenness_Maximum_1",
+        ],
+        [0.05, 0.25, 0.5, 0.75, 0.95],
     )
     file_name = phenology_quantiles_file()
     pheg.to_parquet(file_name)
     return pheg
 
 
-def evi_files_to_parquet():
+def evi_files_to_parquet(backend: str = None):
     """Pre-proocess EVI2 csv files and write parquet"""
-    for lc in config["land_covers"]:
-        for region in config["regions"]:
-            file_name = Path(
-                config["data_dir"], "gee_results", f"VNP13A1_{region}_{lc}_sample.csv"
-            )
-            try:
-                df = pd.read_csv(file_name)
-            except FileNotFoundError:
-                continue
-            # Select good quality observations
-            df = df[df["pixel_reliability"] < 5]
-            df["date"] = pd.to_datetime(df.date)
-            df["woy"] = df.date.dt.isocalendar().week
-            df["doy"] = df.date.dt.dayofyear
-            df["year"] = df.date.dt.year
-            df["lc"] = lc
-            df["Region"] = region
-            out_file_name = Path(
-                config["data_dir"],
-                "gee_results",
-                f"VNP13A1_{region}_{lc}_sample.parquet",
-            )
-            df.to_parquet(out_file_name)
+    map_cells(evi_file_to_parquet, region_lc_cells(), backend)
+
+
+def evi_file_to_parquet(region: str, lc: int):
+    """Pre-proocess EVI2 export of region and lc and write parquet"""
+    try:
+        df = read_gee_table("VNP13A1", region, lc)
+    except FileNotFoundError:
+        return
+    # Select good quality observations
+    df = df[df["pixel_reliability"] < 5]
+    df["woy"] = df.date.dt.isocalendar().week
+    df["doy"] = df.date.dt.dayofyear
+    df["year"] = df.date.dt.year
+    df["lc"] = lc
+    df["Region"] = region
+    out_file_name = Path(
+        config["data_dir"],
+        "gee_results",
+        f"VNP13A1_{region}_{lc}_sample.parquet",
+    )
+    df.to_parquet(out_file_name)
 
 
-def evi_quentiles_land_cover():
+def evi_quentiles_land_cover(backend: str = None):
+    cells = region_lc_cells()
+    hists = map_cells(evi_doy_histogram, cells, backend)
     for lc in config["land_covers"]:
-        dfrs = []
-        for region in config["regions"]:
-            file_name = Path(
-                config["data_dir"],
-                "gee_results",
-                f"VNP13A1_{region}_{lc}_sample.parquet",
-            )
-            try:
-                df = pd.read_parquet(file_name)
-                dfrs.append(df)
-            except FileNotFoundError:
-                continue
-        dfr_land = pd.concat(dfrs)
-        dfr_land["EVI2"] *= 0.0001
-        dfrg = dfr_land.groupby(["doy"]).agg({"EVI2": [q5, q25, q50, q75, q95]})
+        # Exact quantiles from EVI2 integer code histograms merged over regions
+        lc_hists = [
+            hist
+            for (_, cell_lc), hist in zip(cells, hists)
+            if cell_lc == lc and hist is not None
+        ]
+        if len(lc_hists) == 0:
+            continue
+        hist = merge_sketches(lc_hists)
+        dfrg = histogram_quantiles(hist, [0.05, 0.25, 0.5, 0.75, 0.95], scale=0.0001)
         dfrg.columns = dfrg.columns.droplevel(level=0)
         dfrg["lc"] = lc
         dfrg = dfrg.reset_index()
@@ -277,33 +410,35 @@ def evi_quentiles_land_cover():
         dfrg.to_parquet(out_file_name)
 
 
-def evi_quantiles():
+def evi_doy_histogram(region: str, lc: int):
+    """Return EVI2 code histogram per doy of region and lc, None if missing"""
+    file_name = Path(
+        config["data_dir"],
+        "gee_results",
+        f"VNP13A1_{region}_{lc}_sample.parquet",
+    )
+    try:
+        df = pd.read_parquet(file_name)
+    except FileNotFoundError:
+        return None
+    return integer_histograms(df, ["doy"], ["EVI2"])
+
+
+def evi_quantiles(backend: str = None):
     """Calculate EVI2 quantiles per lc and region"""
+    cells = region_lc_cells()
+    hists = map_cells(evi_monthly_histogram, cells, backend)
     results = []
     for lc in config["land_covers"]:
-        dfrs = []
-        for region in config["regions"]:
-            file_name = Path(
-                config["data_dir"], "gee_results", f"VNP13A1_{region}_{lc}_sample.csv"
-            )
-            try:
-                df = pd.read_csv(file_name)
-            except FileNotFoundError:
-                continue
-            # Select good quality observations
-            df = df[df["pixel_reliability"] < 5]
-            df["date"] = pd.to_datetime(df.date)
-            df["month"] = df.date.dt.month
-            df["woy"] = df.date.dt.isocalendar().week
-            df["doy"] = df.date.dt.dayofyear
-            df["year"] = df.date.dt.year
-            df["lc"] = lc
-            df["Region"] = region
-            dfrs.append(df)
-        dfr_evi = pd.concat(dfrs)
-        dfrg = dfr_evi.groupby(["Region", "year", "month"]).agg(
-            {"EVI2": [q5, q25, q50, q75, q95]}
-        )
+        lc_hists = [
+            hist
+            for (_, cell_lc), hist in zip(cells, hists)
+            if cell_lc == lc and hist is not None
+        ]
+        if len(lc_hists) == 0:
+            continue
+        hist = merge_sketches(lc_hists)
+        dfrg = histogram_quantiles(hist, [0.05, 0.25, 0.5, 0.75, 0.95])
         dfrg.columns = dfrg.columns.droplevel(level=0)
         dfrg["lc"] = lc
         dfrg = dfrg.reset_index()
@@ -314,8 +449,24 @@ def evi_quantiles():
     return eviq
 
 
-def UK_fire_dfr(file_path: str, regions_file_path: str):
-    """Read and prepare UK fire detections"""
+def evi_monthly_histogram(region: str, lc: int):
+    """Return EVI2 code histogram per Region, year and month of region
+    and lc, None if missing"""
+    try:
+        df = read_gee_table("VNP13A1", region, lc)
+    except FileNotFoundError:
+        return None
+    # Select good quality observations
+    df = df[df["pixel_reliability"] < 5]
+    df["month"] = df.date.dt.month
+    df["year"] = df.date.dt.year
+    df["Region"] = region
+    return integer_histograms(df, ["Region", "year", "month"], ["EVI2"])
+
+
+def UK_fire_dfr(file_path: str, regions_file_path: str, own_year_lc: bool = False):
+    """Read and prepare UK fire detections. With own_year_lc the lc column
+    is the stacked land cover of the detection year (see lc_stack)"""
     fire = pd.read_parquet(file_path)
     fire["date"] = pd.to_datetime(fire["date"], unit="s")
     fire["year"] = fire.date.dt.year
@@ -325,6 +476,10 @@ def UK_fire_dfr(file_path: str, regions_file_path: str):
     fire["woy"] = fire.date.dt.isocalendar().week
     fire["size"] = fire.groupby("event")["event"].transform("size")
     fire["id"] = fire.id.astype(int)
+    if own_year_lc:
+        from lc_stack import fire_land_cover
+
+        fire["lc"] = fire_land_cover(fire)
     fire = sp.get_UK_climate_region(fire, regions_file_path)
     file_name = fire_file_name()
     fire.to_parquet(file_name)
@@ -332,6 +487,14 @@ def UK_fire_dfr(file_path: str, regions_file_path: str):
 
 
 def UK_fwi_dfr(file_path: str, regions_file_path: str):
+    """Read, prepare and save CEMS FWI indices"""
+    fwi = prepare_fwi(file_path, regions_file_path)
+    file_name = fwi_file_name()
+    fwi.to_parquet(file_name)
+    return fwi
+
+
+def prepare_fwi(file_path: str, regions_file_path: str):
     """Read and prepare CEMS FWI indices"""
     fwi = pd.read_parquet(file_path)
     fwi = fwi.drop("surface", axis=1)
@@ -352,192 +515,191 @@ def UK_fwi_dfr(file_path: str, regions_file_path: str):
     fwi["doy"] = fwi.date.dt.dayofyear
     fwi["dow"] = fwi.date.dt.dayofweek
     fwi["woy"] = fwi.date.dt.isocalendar().week
-    file_name = fwi_file_name()
-    fwi.to_parquet(file_name)
     return fwi
 
 
 def fwi_region_lc_phenology():
     """Determine fuel phenological season for land covers per Region
-    for an arbitrary dataset (dfr)"""
+    for FWI dataset and save the results"""
     file_name = fwi_file_name()
     fwi = pd.read_parquet(file_name)
-    pheq = pd.read_parquet(phenology_quantiles_file())
-    columns = [
-        "Onset_Greenness_Increase_1",
-        "Date_Mid_Greenup_Phase_1",
-        "Onset_Greenness_Maximum_1",
-        "Onset_Greenness_Decrease_1",
-        "Date_Mid_Senescence_Phase_1",
-        "Onset_Greenness_Minimum_1",
-    ]
-    results = []
-    for lc in config["land_covers"]:
-        pheq50 = pheq.loc[(slice(None), lc), (slice(None), "q50")].droplevel(
-            level=1, axis=1
-        )
-        res = pd.merge(
-            fwi,
-            pheq50.reset_index()[columns + ["Region"]],
-            on=["Region"],
-            how="left",
-        )
-        res = phenology_phase_columns(res)
-        res["lc"] = lc
-        results.append(res)
-    results = pd.concat(results)
+    results = fwi_phenology_phases(fwi)
     results.to_parquet(fwi_phen_phase_file())
 
 
-def evi_region_lc_phenology():
+def fwi_phenology_phases(fwi: pd.DataFrame) -> pd.DataFrame:
     """Determine fuel phenological season for land covers per Region
-    for an arbitrary dataset (dfr)"""
-    pheq = pd.read_parquet(phenology_quantiles_file())
-    columns = [
-        "Onset_Greenness_Increase_1",
-        "Date_Mid_Greenup_Phase_1",
-        "Onset_Greenness_Maximum_1",
-        "Onset_Greenness_Decrease_1",
-        "Date_Mid_Senescence_Phase_1",
-        "Onset_Greenness_Minimum_1",
-    ]
-    results = []
+    for an arbitrary FWI dataset (fwi). The table is kept once with
+    an int8 phase code column per land cover (see fwi_phen_phase_lc)"""
+    lookup = PhenologyPhaseLookup.from_phenology_quantiles()
+    res = fwi.copy()
     for lc in config["land_covers"]:
-        for region in config["regions"]:
-            file_name = Path(
-                config["data_dir"], "gee_results", f"VNP13A1_{region}_{lc}_sample.csv"
-            )
-            try:
-                df = pd.read_csv(file_name)
-            except FileNotFoundError:
-                continue
-            # Select good quality observations
-            df = df[df["pixel_reliability"] < 5]
-            df["date"] = pd.to_datetime(df.date)
-            df["doy"] = df.date.dt.dayofyear
-            df["year"] = df.date.dt.year
-            df["lc"] = lc
-            df["Region"] = region
-            pheq50 = pheq.loc[(slice(None), lc), (slice(None), "q50")].droplevel(
-                level=1, axis=1
-            )
-            res = pd.merge(
-                df,
-                pheq50.reset_index()[columns + ["Region"]],
-                on=["Region"],
-                how="left",
-            )
-            res = phenology_phase_columns(res)
-            resg = res.groupby(["Region", "lc", "season", "year"])["EVI2"].quantile(
-                0.25
-            )
-            resg = resg.reset_index()
-            results.append(resg)
-    results = pd.concat(results)
+        res[phase_code_column(lc)] = lookup.codes(res.assign(lc=lc))
+    return res
+
+
+def phase_code_column(lc: int) -> str:
+    """Return name of the phenology phase code column of land cover lc"""
+    return f"season_{lc}"
+
+
+def fwi_phen_phase_lc(fwi_p: pd.DataFrame, lc: int) -> pd.DataFrame:
+    """Return rows of compact phenology phase table fwi_p for land cover lc
+    with lc, season and season_green columns"""
+    code_columns = [
+        phase_code_column(x)
+        for x in config["land_covers"]
+        if phase_code_column(x) in fwi_p.columns
+    ]
+    codes = fwi_p[phase_code_column(lc)].to_numpy()
+    res = fwi_p.drop(code_columns, axis=1)
+    res["lc"] = lc
+    res["season"] = phenology_phase_categorical(codes)
+    res["season_green"] = phenology_green_codes(codes)
+    return res
+
+
+def with_phenology_dates(dfr: pd.DataFrame, quantile: str = "q50") -> pd.DataFrame:
+    """Join phenology phase dates per Region and lc to dfr (e.g. fire
+    detections) when needed rather than storing them with every row"""
+    pheq = pd.read_parquet(phenology_quantiles_file())
+    dates = pheq.loc[:, (phenology_date_columns, quantile)].droplevel(level=1, axis=1)
+    res = pd.merge(dfr, dates.reset_index(), on=["Region", "lc"], how="left")
+    return res
+
+
+def evi_region_lc_phenology(backend: str = None):
+    """Determine fuel phenological season for land covers per Region
+    for an arbitrary dataset (dfr)"""
+    lookup = PhenologyPhaseLookup.from_phenology_quantiles()
+    results = map_cells(
+        partial(evi_phase_quantiles, lookup=lookup), region_lc_cells(), backend
+    )
+    results = pd.concat([x for x in results if x is not None])
     pd.DataFrame(results).to_parquet(evi2_phen_phase_file())
 
 
+def evi_phase_quantiles(region: str, lc: int, lookup):
+    """Return EVI2 25th percentile per phenology phase and year of region
+    and lc, None if missing"""
+    try:
+        df = read_gee_table("VNP13A1", region, lc)
+    except FileNotFoundError:
+        return None
+    # Select good quality observations
+    df = df[df["pixel_reliability"] < 5]
+    df["doy"] = df.date.dt.dayofyear
+    df["year"] = df.date.dt.year
+    df["lc"] = lc
+    df["Region"] = region
+    res = lookup.phase_columns(df)
+    resg = res.groupby(["Region", "lc", "season", "year"], observed=True)[
+        "EVI2"
+    ].quantile(0.25)
+    resg = resg.reset_index()
+    return resg
+
+
 def fire_event_phenology():
-    """Determine fuel phenological season for VIIRS fire events"""
+    """Determine fuel phenological season for VIIRS fire events. Phase
+    dates are not stored, use with_phenology_dates to attach them"""
     fire = pd.read_parquet(fire_file_name())
-    pheq = pd.read_parquet(phenology_quantiles_file())
-    columns = [
-        "Onset_Greenness_Increase_1",
-        "Date_Mid_Greenup_Phase_1",
-        "Onset_Greenness_Maximum_1",
-        "Onset_Greenness_Decrease_1",
-        "Date_Mid_Senescence_Phase_1",
-        "Onset_Greenness_Minimum_1",
-    ]
-    pheq50 = pheq.loc[:, (slice(None), "q50")].droplevel(level=1, axis=1)
-    res = pd.merge(
-        fire,
-        pheq50.reset_index()[columns + ["Region", "lc"]],
-        on=["Region", "lc"],
-        how="left",
-    )
-    res = phenology_phase_columns(res)
+    lookup = PhenologyPhaseLookup.from_phenology_quantiles()
+    res = lookup.phase_columns(fire)
     file_name = fire_phenology_file_name()
     res.to_parquet(file_name)
     return res
 
 
-def fire_pixel_phenology_season():
-    """Determine fuel phenological season for VIIRS fire detections"""
+def fire_pixel_phenology_season(key: str = "event"):
+    """Determine fuel phenological season for VIIRS fire detections from
+    VNP22Q2 dates of the detection's own fire event (key) and year. The
+    dates per event and year are written to their own table, the fire
+    phenology table holds the phases only as fire_event_phenology does"""
     fire = pd.read_parquet(fire_file_name())
-    fire_phen = pd.read_csv(
-        Path(config["data_dir"], "gee_results", "masked_fire_mean_phen_all_events.csv")
-    )
-    columns = [
-        "Onset_Greenness_Increase_1",
-        "Date_Mid_Greenup_Phase_1",
-        "Onset_Greenness_Maximum_1",
-        "Onset_Greenness_Decrease_1",
-        "Date_Mid_Senescence_Phase_1",
-        "Onset_Greenness_Minimum_1",
-    ]
-    fire_phen["year"] = [
-        int(x.split("_")[0]) for x in fire_phen["system:index"].astype(str)
-    ]
+    # system:index is parsed into image year by the ingestion reader
+    fire_phen = read_gee_csv(
+        Path(config["data_dir"], "gee_results", "masked_fire_mean_phen_all_events.csv"),
+        "VNP22Q2",
+    ).to_pandas()
     fire_phen = phenology_doy(fire_phen)
-    fire_phen = fire_phen.drop(["system:index", ".geo"], axis=1)
-    res = pd.merge(
-        fire,
-        fire_phen.reset_index()[columns + ["Region", "lc"]],
-        on=["Region", "lc"],
-        how="left",
+    fire_phen = fire_phen.groupby([key, "year"])[phenology_date_columns].median()
+    fire_phen.reset_index().to_parquet(fire_event_dates_file_name())
+    # Hash index over unique (event, year) keys gives each detection its row
+    positions = fire_phen.index.get_indexer(
+        pd.MultiIndex.from_arrays([fire[key], fire["year"]])
     )
-    res = phenology_phase_columns(res)
+    dates = fire_phen.to_numpy(dtype=float)[positions]
+    dates[positions < 0] = np.nan
+    codes = phenology_phase_codes(fire["doy"].to_numpy(), dates)
+    fire["season"] = phenology_phase_categorical(codes)
+    fire["season_green"] = phenology_green_codes(codes)
     file_name = fire_phenology_file_name()
-    res.to_parquet(file_name)
-    return res
+    fire.to_parquet(file_name)
+    return fire
+
+
+phenology_date_columns = [
+    "Onset_Greenness_Increase_1",
+    "Date_Mid_Greenup_Phase_1",
+    "Onset_Greenness_Maximum_1",
+    "Onset_Greenness_Decrease_1",
+    "Date_Mid_Senescence_Phase_1",
+    "Onset_Greenness_Minimum_1",
+]
+
+phenology_phases = [
+    "Dormant",
+    "Increase_early",
+    "Increase_late",
+    "Maximum",
+    "Decrease_early",
+    "Decrease_late",
+]
+
+# season_green value per phenology phase code
+phenology_phase_green = np.array([0, 0, 1, 1, 1, 0], dtype=np.int8)
+
+
+def phenology_phase_codes(doy, dates):
+    """
+    Return int8 codes of phenology_phases (-1 where undetermined) for
+    day of year array doy and array of the six phenology_date_columns
+    dates with shape (len(doy), 6). A phase covers days after its start
+    date up to and including its end date, Dormant covers days up to
+    the greenness increase onset or after the greenness minimum onset.
+    Where dates are not ordered later phases take precedence.
+    """
+    doy = np.asarray(doy)[:, None]
+    dates = np.asarray(dates, dtype=float)
+    after = doy > dates
+    upto = doy <= dates
+    conditions = [after[:, nr] & upto[:, nr + 1] for nr in range(5)]
+    conditions = [upto[:, 0] | after[:, 5]] + conditions
+    codes = np.select(conditions[::-1], np.arange(5, -1, -1, dtype=np.int8), default=-1)
+    return codes.astype(np.int8)
+
+
+def phenology_phase_categorical(codes) -> pd.Categorical:
+    """Return phenology phase codes as season Categorical"""
+    return pd.Categorical.from_codes(codes, categories=phenology_phases)
+
+
+def phenology_green_codes(codes):
+    """Return nullable Int8 season_green values for phenology phase codes"""
+    codes = np.asarray(codes)
+    green = phenology_phase_green[codes]
+    return pd.array(np.where(codes < 0, None, green), dtype="Int8")
 
 
 def phenology_phase_columns(res):
     """Add columns with phenology phase given day of year
     column for arbitrary dataframe"""
-    res["season"] = None
-    res.loc[
-        (res.doy <= res["Onset_Greenness_Increase_1"])
-        | (res.doy > res["Onset_Greenness_Minimum_1"]),
-        "season",
-    ] = "Dormant"
-    res.loc[
-        (res.doy > res["Onset_Greenness_Increase_1"])
-        & (res.doy <= res["Date_Mid_Greenup_Phase_1"]),
-        "season",
-    ] = "Increase_early"
-    res.loc[
-        (res.doy > res["Date_Mid_Greenup_Phase_1"])
-        & (res.doy <= res["Onset_Greenness_Maximum_1"]),
-        "season",
-    ] = "Increase_late"
-
-    res.loc[
-        (res.doy > res["Onset_Greenness_Maximum_1"])
-        & (res.doy <= res["Onset_Greenness_Decrease_1"]),
-        "season",
-    ] = "Maximum"
-    res.loc[
-        (res.doy > res["Onset_Greenness_Decrease_1"])
-        & (res.doy <= res["Date_Mid_Senescence_Phase_1"]),
-        "season",
-    ] = "Decrease_early"
-    res.loc[
-        (res.doy > res["Date_Mid_Senescence_Phase_1"])
-        & (res.doy <= res["Onset_Greenness_Minimum_1"]),
-        "season",
-    ] = "Decrease_late"
-
-    res["season_green"] = None
-    res.loc[
-        res.season.isin(["Decrease_late", "Dormant", "Increase_early"]),
-        "season_green",
-    ] = 0
-    res.loc[
-        res.season.isin(["Increase_late", "Maximum", "Decrease_early"]),
-        "season_green",
-    ] = 1
+    codes = phenology_phase_codes(
+        res["doy"].to_numpy(), res[phenology_date_columns].to_numpy(dtype=float)
+    )
+    res["season"] = phenology_phase_categorical(codes)
+    res["season_green"] = phenology_green_codes(codes)
     return res
 
     def prepare_lc_counts_per_region():
@@ -545,6 +707,69 @@ def phenology_phase_columns(res):
         dfr = pd.read_parquet(Path(config["data_dir"], "lc_counts_per_region.parquet"))
 
 
+class PhenologyPhaseLookup(object):
+    """
+    Dense lookup cube of phenology phase codes for every combination of
+    the key levels of dates (e.g. Region and lc, optionally year) and day
+    of year. Phases of any table holding the key columns and doy are then
+    found by integer array indexing instead of merging phenology dates.
+    """
+
+    def __init__(self, dates: pd.DataFrame):
+        dates = dates[phenology_date_columns]
+        self.keys = list(dates.index.names)
+        self.levels = [
+            dates.index.get_level_values(key).unique().sort_values()
+            for key in self.keys
+        ]
+        positions = tuple(
+            level.get_indexer(dates.index.get_level_values(key))
+            for key, level in zip(self.keys, self.levels)
+        )
+        doys = np.arange(367)
+        codes = phenology_phase_codes(
+            np.tile(doys, len(dates)),
+            np.repeat(dates.to_numpy(dtype=float), len(doys), axis=0),
+        )
+        self.cube = np.full(
+            [len(level) for level in self.levels] + [len(doys)], -1, dtype=np.int8
+        )
+        self.cube[positions] = codes.reshape(len(dates), len(doys))
+
+    @classmethod
+    def from_phenology_quantiles(cls, quantile: str = "q50"):
+        """Build (Region, lc) lookup from phenology date quantiles"""
+        pheq = pd.read_parquet(phenology_quantiles_file())
+        dates = pheq.loc[:, (slice(None), quantile)].droplevel(level=1, axis=1)
+        return cls(dates)
+
+    @classmethod
+    def from_phenology_years(cls):
+        """Build (Region, lc, year) lookup from yearly median phenology dates"""
+        phe = pd.read_parquet(phenology_file())
+        dates = phe.groupby(["Region", "lc", "year"])[phenology_date_columns].median()
+        return cls(dates)
+
+    def codes(self, dfr: pd.DataFrame):
+        """Return int8 phenology phase codes for rows of dfr, -1 where
+        dfr key values are not found in the lookup"""
+        positions = [
+            level.get_indexer(dfr[key]) for key, level in zip(self.keys, self.levels)
+        ]
+        found = np.logical_and.reduce([x >= 0 for x in positions])
+        doy = dfr["doy"].to_numpy()
+        codes = self.cube[tuple(positions) + (doy,)]
+        codes[~found] = -1
+        return codes
+
+    def phase_columns(self, dfr: pd.DataFrame) -> pd.DataFrame:
+        """Add season and season_green columns to dfr"""
+        codes = self.codes(dfr)
+        dfr["season"] = phenology_phase_categorical(codes)
+        dfr["season_green"] = phenology_green_codes(codes)
+        return dfr
+
+
 if __name__ == "__main__":
     # eviq = evi_quantiles()
     # phe = combine_phenology()
@@ -564,6 +789,12 @@ if __name__ == "__main__":
     # )
     #
     # fwi_doy_quantiles()
+    # Store yearly FWI sketches once, then add new seasons with update_fwi_year
+    # fwi_year_sketches(pd.read_parquet(fwi_file_name()))
+    # update_fwi_year(
+    #     "/Users/tadas/modFire/fire_lc_ndvi/data/fwi/uk_fwi_variables_2023.parquet",
+    #     config["regions_file"],
+    # )
     # fwi = pd.read_parquet(fwi_file_name())
     # fwi_ph = region_lc_phenology(fwi)
     # fwi_region_lc_phenology()
@@ -0,0 +1,273 @@
+"""
+Grouped quantile calculations used for building climatologies
+author: tadasnik@gmail.com
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def quantile_label(q: float) -> str:
+    """Return column label for quantile q, matching the q5...q99 helpers"""
+    return f"q{q * 100:g}"
+
+
+def sorted_group_quantiles(values, starts, counts, quantiles):
+    """Read quantiles off values sorted within contiguous groups given
+    group start positions and counts of valid (non NaN) values. Uses
+    linear interpolation as pandas.Series.quantile does. Returns
+    array of shape (number of groups, number of quantiles)"""
+    quantiles = np.asarray(quantiles, dtype=float)
+    starts = np.asarray(starts)
+    counts = np.asarray(counts)
+    result = np.full((len(starts), len(quantiles)), np.nan)
+    valid = counts > 0
+    if not valid.any():
+        return result
+    h = (counts[valid, None] - 1) * quantiles[None, :]
+    lo = np.floor(h).astype(np.int64)
+    hi = np.minimum(lo + 1, counts[valid, None] - 1)
+    frac = h - lo
+    base = starts[valid, None]
+    low_values = values[base + lo]
+    high_values = values[base + hi]
+    result[valid] = low_values + (high_values - low_values) * frac
+    return result
+
+
+def grouped_quantiles(
+    dfr: pd.DataFrame, by: list, columns: list, quantiles: list
+) -> pd.DataFrame:
+    """
+    Calculate quantiles of columns in dfr grouped by by columns. Rows
+    of each column are sorted once by (group, value) and all quantiles
+    are read off the sorted array. The result has the same layout as
+    dfr.groupby(by).agg({column: [q5, q25, ...]}), i.e. group keys in
+    the index and (column, "q5") MultiIndex columns.
+    """
+    gdfr = dfr.groupby(by, sort=True)
+    codes = gdfr.ngroup().to_numpy()
+    index = gdfr.size().index
+    n_groups = len(index)
+    keep = codes >= 0
+    codes = codes[keep]
+    labels = [quantile_label(q) for q in quantiles]
+    totals = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(totals)[:-1]])
+    data = {}
+    for column in columns:
+        values = dfr[column].to_numpy(dtype=float, na_value=np.nan)[keep]
+        # NaNs sort to the end of each group and are excluded from counts
+        counts = np.bincount(codes[~np.isnan(values)], minlength=n_groups)
+        order = np.lexsort((values, codes))
+        result = sorted_group_quantiles(values[order], starts, counts, quantiles)
+        for nr, label in enumerate(labels):
+            data[(column, label)] = result[:, nr]
+    res = pd.DataFrame(data, index=index)
+    res.columns = pd.MultiIndex.from_tuples(res.columns)
+    return res
+
+
+# Relative accuracy of quantile sketches and the smallest absolute value
+# resolved by them. Values with smaller magnitude are counted as zero.
+SKETCH_ALPHA = 0.005
+SKETCH_MIN_VALUE = 1e-3
+
+
+def sketch_gamma(alpha: float) -> float:
+    """Return bucket growth factor for relative accuracy alpha"""
+    return (1 + alpha) / (1 - alpha)
+
+
+def sketch_bucket_offset(alpha: float, min_value: float) -> int:
+    """Return offset making all bucket keys of values >= min_value positive"""
+    gamma = sketch_gamma(alpha)
+    return 1 - int(np.ceil(np.log(min_value) / np.log(gamma)))
+
+
+def sketch_buckets(values, alpha=SKETCH_ALPHA, min_value=SKETCH_MIN_VALUE):
+    """
+    Map values to signed logarithmic bucket keys. Bucket k > 0 holds
+    values in (gamma^(k - offset - 1), gamma^(k - offset)], negative keys
+    mirror this for negative values and key 0 holds values with magnitude
+    below min_value. Keys are ordered as the values they represent.
+    """
+    values = np.asarray(values, dtype=float)
+    gamma = sketch_gamma(alpha)
+    offset = sketch_bucket_offset(alpha, min_value)
+    magnitude = np.abs(values)
+    large = magnitude >= min_value
+    keys = np.zeros(values.shape, dtype=np.int32)
+    keys[large] = np.ceil(np.log(magnitude[large]) / np.log(gamma)) + offset
+    return np.where(values < 0, -keys, keys)
+
+
+def sketch_bucket_values(keys, alpha=SKETCH_ALPHA, min_value=SKETCH_MIN_VALUE):
+    """Return representative values of bucket keys, within relative
+    error alpha of any value falling in the bucket"""
+    keys = np.asarray(keys)
+    gamma = sketch_gamma(alpha)
+    offset = sketch_bucket_offset(alpha, min_value)
+    magnitude = 2 * gamma ** (np.abs(keys) - offset) / (gamma + 1)
+    return np.where(keys == 0, 0.0, np.sign(keys) * magnitude)
+
+
+def quantile_sketch(
+    dfr: pd.DataFrame,
+    by: list,
+    columns: list,
+    alpha: float = SKETCH_ALPHA,
+    min_value: float = SKETCH_MIN_VALUE,
+) -> pd.DataFrame:
+    """
+    Build mergeable quantile sketches of columns in dfr grouped by by
+    columns. The sketch is a long table of bucket counts indexed by
+    by + ["variable", "bucket"], so its size depends on the number of
+    groups and occupied buckets, not on the number of rows in dfr.
+    """
+    sketches = []
+    for column in columns:
+        values = dfr[column].to_numpy(dtype=float, na_value=np.nan)
+        valid = ~np.isnan(values)
+        sub = dfr.loc[valid, by].copy()
+        sub["variable"] = column
+        sub["bucket"] = sketch_buckets(values[valid], alpha, min_value)
+        sketches.append(sub.groupby(by + ["variable", "bucket"]).size())
+    sketch = pd.concat(sketches).rename("count").to_frame()
+    return sketch
+
+
+def merge_sketches(sketches: list) -> pd.DataFrame:
+    """Merge quantile sketches built with the same alpha and min_value,
+    e.g. from different row groups or years"""
+    sketch = pd.concat(sketches)
+    sketch = sketch.groupby(level=list(range(sketch.index.nlevels))).sum()
+    return sketch
+
+
+def stream_quantile_sketch(
+    file_name,
+    by: list,
+    columns: list,
+    alpha: float = SKETCH_ALPHA,
+    min_value: float = SKETCH_MIN_VALUE,
+    batch_size: int = 1_000_000,
+) -> pd.DataFrame:
+    """
+    Build quantile sketch of columns grouped by by columns reading parquet
+    file_name in record batches. Only one batch and the merged sketch are
+    held in memory at any time.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(file_name)
+    sketch = None
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=by + columns):
+        part = quantile_sketch(batch.to_pandas(), by, columns, alpha, min_value)
+        sketch = part if sketch is None else merge_sketches([sketch, part])
+    return sketch
+
+
+def count_table_quantiles(
+    counts: pd.DataFrame, bucket_values, quantiles: list
+) -> pd.DataFrame:
+    """
+    Read quantiles off a long table of value counts indexed by group
+    levels + ["variable", "bucket"], with bucket_values giving the value
+    represented by each row. Values at the two ranks bracketing
+    q * (n - 1) are linearly interpolated as pandas.Series.quantile does.
+    Returns the same layout as grouped_quantiles.
+    """
+    levels = counts.index.names[:-1]
+    order = np.lexsort(
+        [counts.index.get_level_values(x) for x in reversed(counts.index.names)]
+    )
+    counts = counts.iloc[order]
+    bucket_values = np.asarray(bucket_values)[order]
+    cumulative = np.cumsum(counts["count"].to_numpy())
+    gcounts = counts.groupby(level=levels, sort=False)
+    sizes = gcounts.size()
+    totals = gcounts["count"].sum().to_numpy()
+    offsets = cumulative[np.cumsum(sizes.to_numpy()) - 1] - totals
+    data = {}
+    for q in quantiles:
+        rank = (totals - 1) * q
+        lo = np.floor(rank)
+        lo_pos = np.searchsorted(cumulative, offsets + lo, side="right")
+        hi_pos = np.searchsorted(
+            cumulative, offsets + np.minimum(lo + 1, totals - 1), side="right"
+        )
+        low_values = bucket_values[lo_pos]
+        high_values = bucket_values[hi_pos]
+        data[quantile_label(q)] = low_values + (high_values - low_values) * (rank - lo)
+    res = pd.DataFrame(data, index=sizes.index)
+    res = res.unstack("variable")
+    res.columns = res.columns.swaplevel(0, 1)
+    variables = counts.index.get_level_values("variable").unique()
+    labels = [quantile_label(q) for q in quantiles]
+    res = res.reindex(columns=pd.MultiIndex.from_product([variables, labels]))
+    return res
+
+
+def sketch_quantiles(
+    sketch: pd.DataFrame,
+    quantiles: list,
+    alpha: float = SKETCH_ALPHA,
+    min_value: float = SKETCH_MIN_VALUE,
+) -> pd.DataFrame:
+    """
+    Read quantiles off a quantile sketch. The values at the two ranks
+    bracketing q * (n - 1) are estimated from their buckets and linearly
+    interpolated as pandas.Series.quantile does. Each result is within
+    relative error alpha of the exact quantile (absolute error min_value
+    for values closer to zero) only if the two bracketing values have
+    the same sign, interpolating between a negative and a positive
+    bucket has no relative error bound. Returns the same layout as
+    grouped_quantiles.
+    """
+    buckets = sketch.index.get_level_values("bucket").to_numpy()
+    bucket_values = sketch_bucket_values(buckets, alpha, min_value)
+    return count_table_quantiles(sketch, bucket_values, quantiles)
+
+
+def integer_histograms(dfr: pd.DataFrame, by: list, columns: list) -> pd.DataFrame:
+    """
+    Count values of integer coded columns (e.g. VNP13A1 EVI2 scaled by
+    10000) per group with a single np.bincount over group * n_codes + code.
+    Returns a long table of non zero counts indexed by by + ["variable",
+    "bucket"] in the quantile sketch layout, hence histograms of different
+    regions or years can be combined with merge_sketches.
+    """
+    gdfr = dfr.groupby(by, sort=True)
+    codes = gdfr.ngroup().to_numpy()
+    index = gdfr.size().index
+    hists = []
+    for column in columns:
+        valid = dfr[column].notna().to_numpy() & (codes >= 0)
+        values = dfr[column].to_numpy()[valid].astype(np.int64)
+        groups = codes[valid]
+        if len(values) == 0:
+            continue
+        min_code = values.min()
+        n_codes = values.max() - min_code + 1
+        counts = np.bincount(
+            groups * n_codes + (values - min_code), minlength=len(index) * n_codes
+        )
+        flat = np.flatnonzero(counts)
+        hist = index[flat // n_codes].to_frame(index=False)
+        hist["variable"] = column
+        hist["bucket"] = flat % n_codes + min_code
+        hist["count"] = counts[flat]
+        hists.append(hist.set_index(by + ["variable", "bucket"]))
+    return pd.concat(hists)
+
+
+def histogram_quantiles(
+    hist: pd.DataFrame, quantiles: list, scale: float = 1.0
+) -> pd.DataFrame:
+    """
+    Read exact quantiles off integer histograms, with values multiplied by
+    scale. Equals grouped_quantiles of the scaled values at O(n) cost.
+    """
+    codes = hist.index.get_level_values("bucket").to_numpy()
+    return count_table_quantiles(hist, codes * scale, quantiles)
@@ -1,5 +1,7 @@
-import os, sys
+import numpy as np
+import rasterio
 from osgeo import gdal
+from rasterio.windows import Window
 
 def get_bbox(ds):
     geoTransform = ds.GetGeoTransform()
@@ -9,21 +11,34 @@ def get_bbox(ds):
     miny = maxy + geoTransform[5] * ds.RasterYSize
     return minx, miny, maxx, maxy
 
-def split_to_tiles(file_name):
-    ds = gdal.Open(file_name, gdal.gdalconst.GA_ReadOnly)
-    width = ds.RasterXSize
-    height = ds.RasterYSize
+def raster_windows(file_name, block_size=11000):
+    """Return windows covering the raster in block_size x block_size blocks"""
+    with rasterio.open(file_name) as src:
+        width = src.width
+        height = src.height
     print(width, 'x', height)
-    tilesize = 11000
-    for i in range(0, width, tilesize):
-        for j in range(0, height, tilesize):
-            w = min(i+tilesize, width) - i
-            h = min(j+tilesize, height) - j
-            gdaltranString = "gdal_translate -of GTIFF -srcwin " + str(i) +
-                             ", " + str(j) + ", " + str(w) + ", " + str(h) +
-                             " " + file_name + " " +
-                             "_" + str(i) + "_" + str(j) + ".tif"
-            os.system(gdaltranString)
+    windows = []
+    for i in range(0, width, block_size):
+        for j in range(0, height, block_size):
+            w = min(i + block_size, width) - i
+            h = min(j + block_size, height) - j
+            windows.append(Window(i, j, w, h))
+    return windows
+
+def read_window(src, window, overlap=0, band=1):
+    """Read band values of the window padded with overlap pixels on every
+    side from the neighbouring blocks. Pixels beyond the raster are 0"""
+    left = window.col_off - overlap
+    top = window.row_off - overlap
+    right = window.col_off + window.width + overlap
+    bottom = window.row_off + window.height + overlap
+    values = np.zeros((bottom - top, right - left), dtype=src.dtypes[band - 1])
+    c_start, c_end = max(left, 0), min(right, src.width)
+    r_start, r_end = max(top, 0), min(bottom, src.height)
+    inner = Window(c_start, r_start, c_end - c_start, r_end - r_start)
+    values[r_start - top:r_end - top, c_start - left:c_end - left] = src.read(
+        band, window=inner)
+    return values
 
 #Clipping larger raster to extent of a smaller one:
 #1. Get shapefile with smaller raster extent
@@ -1,29 +1,199 @@
+import threading
+import numpy as np
 import pyproj
+import shapely
 import geopandas as gpd
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.features import rasterize
+from rasterio.transform import from_origin
+
+# Transformers are not shared between threads, each thread caches its own
+transformer_cache = threading.local()
+
+
+def get_transformer(crs_from: str, crs_to: str) -> pyproj.Transformer:
+    """Return cached always_xy transformer of the calling thread"""
+    if not hasattr(transformer_cache, "transformers"):
+        transformer_cache.transformers = {}
+    key = (crs_from, crs_to)
+    if key not in transformer_cache.transformers:
+        transformer_cache.transformers[key] = pyproj.Transformer.from_crs(
+            crs_from, crs_to, always_xy=True
+        )
+    return transformer_cache.transformers[key]
+
+
+def transform_coordinates(
+    xx, yy, crs_from: str, crs_to: str, chunk_size: int = 1_000_000, max_workers=None
+):
+    """
+    Transform coordinates xx, yy (x/longitude first) from crs_from to
+    crs_to. Results are written in place into preallocated float arrays,
+    large inputs are transformed in chunk_size chunks across threads.
+    """
+    out_x = np.array(xx, dtype="float64")
+    out_y = np.array(yy, dtype="float64")
+    chunks = [
+        slice(start, start + chunk_size) for start in range(0, len(out_x), chunk_size)
+    ]
+
+    def transform_chunk(chunk):
+        transformer = get_transformer(crs_from, crs_to)
+        # inplace writes into the contiguous chunk views, the assignment
+        # only matters if pyproj had to fall back to a copy
+        out_x[chunk], out_y[chunk] = transformer.transform(
+            out_x[chunk], out_y[chunk], inplace=True
+        )
+
+    if len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(transform_chunk, chunks))
+    else:
+        for chunk in chunks:
+            transform_chunk(chunk)
+    return out_x, out_y
 
 
 def lonlat_to_osgb(dfr):
-    transformer = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:27700")
-    dfr["x"], dfr["y"] = transformer.transform(dfr["latitude"], dfr["longitude"])
+    dfr["x"], dfr["y"] = transform_coordinates(
+        dfr["longitude"], dfr["latitude"], "EPSG:4326", "EPSG:27700"
+    )
     return dfr
 
 
 def osgb_to_lonlat(dfr):
-    dfr = dfr.reset_index()
-    transformer = pyproj.Transformer.from_crs("EPSG:27700", "EPSG:4326", always_xy=True)
-    dfr["longitude"], dfr["latitude"] = transformer.transform(dfr["x"], dfr["y"])
-    dfr = dfr.drop(["x", "y"], axis=1)
-    return dfr
+    """Return dfr with x, y (columns or index levels) replaced by longitude
+    and latitude columns and other index levels as columns"""
+    levels = [name for name in dfr.index.names if name is not None]
+    x = dfr.index.get_level_values("x") if "x" in levels else dfr["x"]
+    y = dfr.index.get_level_values("y") if "y" in levels else dfr["y"]
+    longitude, latitude = transform_coordinates(x, y, "EPSG:27700", "EPSG:4326")
+    data = {
+        name: dfr.index.get_level_values(name).to_numpy()
+        for name in levels
+        if name not in ["x", "y"]
+    }
+    for column in dfr.columns:
+        if column not in ["x", "y"]:
+            data[column] = dfr[column].to_numpy()
+    data["longitude"] = longitude
+    data["latitude"] = latitude
+    return pd.DataFrame(data, copy=False)
+
+
+# VNP13A1 500 m global sinusoidal grid
+SINUSOIDAL_RADIUS = 6371007.181
+SINUSOIDAL_ORIGIN = (-20015109.354, 10007554.677)
+VNP13A1_PIXEL_SIZE = 463.31271652791665
+VNP13A1_COLUMNS = 86400
+
+
+def lonlat_to_vnp13a1_cell(longitude, latitude):
+    """Return VNP13A1 sinusoidal grid cell ids (row * VNP13A1_COLUMNS + col)
+    of longitude, latitude"""
+    lat = np.radians(np.asarray(latitude, dtype=float))
+    lon = np.radians(np.asarray(longitude, dtype=float))
+    x = SINUSOIDAL_RADIUS * lon * np.cos(lat)
+    y = SINUSOIDAL_RADIUS * lat
+    col = np.floor((x - SINUSOIDAL_ORIGIN[0]) / VNP13A1_PIXEL_SIZE).astype(np.int64)
+    row = np.floor((SINUSOIDAL_ORIGIN[1] - y) / VNP13A1_PIXEL_SIZE).astype(np.int64)
+    return row * VNP13A1_COLUMNS + col
+
+
+def osgb_to_vnp13a1_cell(x, y):
+    """Return VNP13A1 sinusoidal grid cell ids of OSGB x, y"""
+    longitude, latitude = transform_coordinates(x, y, "EPSG:27700", "EPSG:4326")
+    return lonlat_to_vnp13a1_cell(longitude, latitude)
+
+
+class RegionIndex(object):
+    """
+    Point to UK climate region lookup. HadUKP regions are rasterized once
+    onto an OSGB grid with the given resolution (m), so most points are
+    assigned by integer array indexing. Points in grid cells crossed by
+    a region boundary are tested against the exact region polygons.
+    """
+
+    def __init__(self, file_name, resolution: float = 250.0):
+        regions = gpd.read_file(file_name)
+        regions = regions.set_crs("EPSG:27700")
+        self.attributes = pd.DataFrame(regions.drop(columns="geometry"))
+        self.attributes = self.attributes.reset_index(drop=True)
+        self.geometries = regions.geometry.values
+        self.resolution = resolution
+        self.minx, miny, maxx, self.maxy = regions.total_bounds
+        self.shape = (
+            int(np.ceil((self.maxy - miny) / resolution)),
+            int(np.ceil((maxx - self.minx) / resolution)),
+        )
+        transform = from_origin(self.minx, self.maxy, resolution, resolution)
+        # Region codes are row number + 1, 0 is outside all regions
+        self.codes = rasterize(
+            [(geom, nr + 1) for nr, geom in enumerate(self.geometries)],
+            out_shape=self.shape,
+            transform=transform,
+            fill=0,
+            dtype="uint8",
+        )
+        self.edges = rasterize(
+            [(geom.boundary, 1) for geom in self.geometries],
+            out_shape=self.shape,
+            transform=transform,
+            fill=0,
+            all_touched=True,
+            dtype="uint8",
+        ).astype(bool)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def lookup_xy(self, x, y):
+        """Return region codes (row number + 1, 0 outside) of OSGB x, y"""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        cols = np.floor((x - self.minx) / self.resolution).astype(np.int64)
+        rows = np.floor((self.maxy - y) / self.resolution).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0)
+        inside &= cols < self.shape[1]
+        codes = np.zeros(x.shape, dtype=np.int64)
+        codes[inside] = self.codes[rows[inside], cols[inside]]
+        exact = np.zeros(x.shape, dtype=bool)
+        exact[inside] = self.edges[rows[inside], cols[inside]]
+        if exact.any():
+            points = shapely.points(x[exact], y[exact])
+            point_nrs, geom_nrs = self.tree.query(points, predicate="intersects")
+            exact_codes = np.zeros(len(points), dtype=np.int64)
+            exact_codes[point_nrs] = geom_nrs + 1
+            codes[exact] = exact_codes
+        return codes
+
+    def lookup_lonlat(self, longitude, latitude):
+        """Return region codes of WGS84 longitude, latitude"""
+        x, y = transform_coordinates(longitude, latitude, "EPSG:4326", "EPSG:27700")
+        return self.lookup_xy(x, y)
+
+    def assign(self, dfr: pd.DataFrame) -> pd.DataFrame:
+        """Return rows of dfr (with longitude and latitude columns) falling
+        in a region, with the region attribute columns added"""
+        codes = self.lookup_lonlat(dfr["longitude"].values, dfr["latitude"].values)
+        found = codes > 0
+        res = dfr[found].copy()
+        attributes = self.attributes.iloc[codes[found] - 1]
+        for column in attributes.columns:
+            res[column] = attributes[column].values
+        return res
+
+
+region_indexes = {}
+
+
+def get_region_index(file_name, resolution: float = 250.0) -> RegionIndex:
+    """Return RegionIndex of regions file_name, built on first use"""
+    key = (str(file_name), resolution)
+    if key not in region_indexes:
+        region_indexes[key] = RegionIndex(file_name, resolution)
+    return region_indexes[key]
 
 
 def get_UK_climate_region(dfr, file_name):
-    regions = gpd.read_file(file_name)
-    regions = regions.set_crs("EPSG:27700")
-    regions = regions.to_crs("EPSG:4326")
-    geometry = gpd.points_from_xy(dfr.longitude, dfr.latitude)
-    gdf = gpd.GeoDataFrame(dfr, geometry=geometry, crs=4326)
-    pts = gpd.sjoin(regions, gdf)
-    pts = pts.drop(["geometry", "index_right"], axis=1)
-    df = pd.DataFrame(pts)
-    return df
+    return get_region_index(file_name).assign(dfr)